@@ -1,102 +1,564 @@
 """
-Allows you to pick a context and then lists all pods in the chosen context. A
-context includes a cluster, a user, and a namespace.
-Please install the pick library before running this example.
+Get condor queue status, running jobs and finished jobs from the schedd
+
+The schedd is queried through the htcondor python bindings when they are
+installed, otherwise by running condor_q/condor_history. Both backends return
+job ads as dicts keyed by lower case attribute names.
 """
 
+import codecs
 import subprocess
 import logging
+import threading
 import time
 import json
+import queue
+import random
+from contextlib import contextmanager
+
+from afmetrics_collector.constraint import Constraint, is_literal
+from afmetrics_collector.state import Stateful, StateStore
+
+try:
+    import htcondor
+except ImportError:
+    htcondor = None
 
 _logger = logging.getLogger(__name__)
 
+BACKENDS = ["auto", "bindings", "cli"]
+
+JOB_STATES = {0: "unexpanded",
+              1: "idle",
+              2: "running",
+              3: "removed",
+              4: "finished",
+              5: "held",
+              6: "submission_err",
+             }
+
+
+@contextmanager
+def deadline(process, timeout=None):
+    """kill process if it is still running after timeout seconds"""
+    if timeout is None:
+        yield
+        return
+    timer = threading.Timer(timeout, process.kill)
+    timer.daemon = True
+    timer.start()
+    try:
+        yield
+    finally:
+        timer.cancel()
+
+
+def iter_json_array(stream, chunk_size=65536):
+    """yield the elements of a json array read from a binary stream, one at a time
+
+    Only the element being decoded is kept in memory, not the whole document.
+    """
+    decoder = json.JSONDecoder()
+    # a multi byte character may be split between two chunks
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    started = False
+    eof = False
+    while True:
+        pos = 0
+        while True:
+            # skip whitespace and the array punctuation between elements
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buf) and not started:
+                if buf[pos] != "[":
+                    raise ValueError("expected a json array, got {!r}".format(buf[pos:pos+20]))
+                started = True
+                pos += 1
+                continue
+            if pos < len(buf) and buf[pos] == "]":
+                return
+            if pos >= len(buf):
+                break
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                break
+            pos = end
+            yield item
+        buf = buf[pos:]
+        if eof:
+            if buf.strip():
+                raise ValueError("truncated json array")
+            return
+        chunk = stream.read1(chunk_size) if hasattr(stream, "read1") else stream.read(chunk_size)
+        if not chunk:
+            eof = True
+        buf += utf8.decode(chunk, final=eof)
+
+
+class CliSchedd:
+    """CliSchedd class queries the schedd with condor_q/condor_history, like htcondor.Schedd
+
+    Ads are parsed and yielded as condor prints them, so memory use does not
+    depend on the number of jobs.
+    """
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    def _run(self, cmd):
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as process, \
+                deadline(process, self.timeout):
+            try:
+                for ad in iter_json_array(process.stdout):
+                    yield {k.lower(): v for k, v in ad.items()}
+            except BaseException:
+                # the consumer stopped early or parsing failed
+                process.kill()
+                raise
+        if process.returncode:
+            raise RuntimeError("{} exited with {}".format(cmd[0], process.returncode))
+
+    def query(self, constraint="true", projection=[]):
+        cmd = ['condor_q', '-all', '-json', '-constraint', constraint]
+        if projection:
+            cmd += ['-attributes', ",".join(projection)]
+        return self._run(cmd)
+
+    def history(self, constraint="true", projection=[], match=-1, since=None):
+        cmd = ['condor_history', '-json', '-constraint', constraint]
+        if projection:
+            cmd += ['-attributes', ",".join(projection)]
+        if match >= 0:
+            cmd += ['-match', str(match)]
+        if since:
+            cmd += ['-since', since]
+        return self._run(cmd)
+
+
+def bounded(read, timeout=None, buffer=1000):
+    """yield the ads of read(), raising TimeoutError once timeout seconds passed
+
+    The htcondor bindings have no timeout of their own, so the ads are read
+    in a daemon thread; one still blocked in the schedd after the deadline
+    is abandoned. At most `buffer` ads wait for the consumer, so memory use
+    still does not depend on the number of jobs.
+    """
+    if timeout is None:
+        yield from read()
+        return
+    results = queue.Queue(maxsize=buffer)
+    stop = threading.Event()
+
+    def put(item):
+        # give up once the consumer is gone instead of waiting on a full queue
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            for ad in read():
+                if not put(("ad", ad)):
+                    return
+            put(("done", None))
+        except Exception as error:
+            put(("error", error))
+
+    end = time.monotonic() + timeout
+    threading.Thread(target=reader, daemon=True).start()
+    try:
+        while True:
+            try:
+                kind, value = results.get(timeout=max(0, end - time.monotonic()))
+            except queue.Empty:
+                raise TimeoutError("schedd query still running after {}s".format(timeout))
+            if kind == "ad":
+                yield value
+            elif kind == "error":
+                raise value
+            else:
+                return
+    finally:
+        stop.set()
+
+
+class BindingsSchedd:
+    """BindingsSchedd class queries the schedd through the htcondor python bindings
+
+    A query still running after timeout seconds raises TimeoutError, like a
+    killed condor_q does with the cli backend.
+    """
+    def __init__(self, timeout=None, schedd=None):
+        self.timeout = timeout
+        self.schedd = schedd if schedd is not None else htcondor.Schedd()
+
+    def query(self, constraint="true", projection=[]):
+        # xquery streams the ads, newer bindings only have query
+        query = getattr(self.schedd, "xquery", self.schedd.query)
+        for ad in bounded(lambda: query(constraint=constraint, projection=projection),
+                          self.timeout):
+            yield {k.lower(): v for k, v in ad.items()}
+
+    def history(self, constraint="true", projection=[], match=-1, since=None):
+        kwargs = {"since": since} if since else {}
+        for ad in bounded(lambda: self.schedd.history(constraint, projection, match=match,
+                                                      **kwargs),
+                          self.timeout):
+            yield {k.lower(): v for k, v in ad.items()}
+
+
+_bindings_schedds = {}
+
+
+def get_schedd(backend="auto", timeout=None):
+    """pick the schedd backend
+
+    Args:
+      backend (str): "bindings", "cli" or "auto" (bindings if they are installed)
+      timeout (float): seconds after which a query fails: condor_q/condor_history
+          are killed, a bindings query is abandoned
+
+    Returns:
+      schedd: object with query() and history() methods
+    """
+    if backend not in BACKENDS:
+        raise ValueError("unknown condor backend: {}".format(backend))
+    if backend != "cli":
+        if htcondor is not None:
+            if timeout not in _bindings_schedds:
+                _bindings_schedds[timeout] = BindingsSchedd(timeout=timeout)
+            return _bindings_schedds[timeout]
+        if backend == "bindings":
+            _logger.warning("htcondor bindings are not installed, using condor_q/condor_history")
+    return CliSchedd(timeout=timeout)
+
+
+def _count(ad, queue_status):
+    status = ad.get("jobstatus")
+    if status == 1:
+        queue_status["idle"] += 1
+    elif status == 2:
+        queue_status["running"] += 1
+        queue_status["allocated_cores"] += int(ad.get("cpusprovisioned", 0))
+        queue_status["allocated_mem"] += int(ad.get("memoryprovisioned", 0))
+    elif status == 5:
+        queue_status["held"] += 1
+
+
 def get_condor_queue_summery(queues=[{"name": 'all', "constraint": ""},
-                                     {"name": 'short', "constraint": 'queue == "short"'}]):
+                                     {"name": 'short', "constraint": 'queue == "short"'}],
+                             timeout=None, single_query=True, schedd=None):
+    """get idle/running/held counts and allocated resources of each queue
+
+    Args:
+      queues (list): dicts with the queue name and its condor constraint
+      timeout (float): seconds after which condor_q is killed
+      single_query (bool): query the schedd once and evaluate the queue
+          constraints here, instead of one query per queue
+      schedd: schedd to query, see :func:`get_schedd`
+
+    Returns:
+      summery: list of queue status dicts, without the queues that could not
+          be counted (all of them if the single query failed)
+    """
+    if schedd is None:
+        schedd = get_schedd(timeout=timeout)
+    attributes = ["JobStatus", "CpusProvisioned", "MemoryProvisioned"]
+    if single_query and queues:
+        try:
+            constraints = [Constraint(queue["constraint"]) for queue in queues]
+        except ValueError as error:
+            _logger.warning("falling back to one query per queue: %s", error)
+        else:
+            for constraint in constraints:
+                attributes.extend(a for a in sorted(constraint.attributes)
+                                  if a.lower() not in (b.lower() for b in attributes))
+            summery = [_queue_status(queue["name"]) for queue in queues]
+            try:
+                if _count_queues(schedd, attributes, constraints, summery):
+                    return summery
+            except Exception as error:
+                _logger.error(error)
+                return []
+
     summery = []
     for queue in queues:
-        queue_status = {}
-        cmd = ['condor_q', '-all', '-totals', '-json']
-        if queue["constraint"]:
-            cmd = cmd + ["-constraint", queue["constraint"]]
-        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as process:
-            result = json.loads(process.stdout.read())
-            queue_status.update({"queue": queue["name"],
-                                 "idle": result[0]["Idle"],
-                                 "running": result[0]["Running"],
-                                 "held": result[0]["Held"]})
-
-        cmd = ['condor_q', '-all', '-run', '-autoformat', 'CpusProvisioned', 'MemoryProvisioned', '-json']
-        if queue["constraint"]:
-            cmd = cmd + ["-constraint", queue["constraint"]]
+        queue_status = _queue_status(queue["name"])
         try:
-            with subprocess.Popen(cmd, stdout=subprocess.PIPE) as process:
-                result = json.loads(process.stdout.read())
-                allocated_cores = sum(int(item.get('CpusProvisioned',0)) for item in result) 
-                allocated_mem = sum(int(item.get('MemoryProvisioned',0)) for item in result) 
-                queue_status.update({"allocated_cores": allocated_cores, "allocated_mem": allocated_mem})
+            for ad in schedd.query(queue["constraint"] or "true", attributes):
+                _count(ad, queue_status)
         except Exception as error:
-            _logger.error(error)
-
+            # partial counts would look like real ones
+            _logger.error("cannot count queue %s: %s", queue["name"], error)
+            continue
         summery.append(queue_status)
 
     return summery
 
-def get_condor_jobs():
-
-    jobs = []
-    keys = ["users", "Id", "Runtime", "state"]
-    job_st = {"0": "unexpanded",
-              "1": "idle",
-              "2": "running",
-              "3": "removed",
-              "4": "finished",
-              "5": "held",
-              "6": "submission_err",
-             }
-    constraint = 'Owner =!= \"{}\"'.format('atlas-coffea')
 
-    #'-completedsince', str(now - since_insecs) not working?
+def _queue_status(name):
+    return {"queue": name, "idle": 0, "running": 0, "held": 0,
+            "allocated_cores": 0, "allocated_mem": 0}
+
+
+def _count_queues(schedd, attributes, constraints, summery):
+    """count the jobs of every queue from a single query
+
+    Returns:
+      counted: False if an attribute a constraint uses is an expression, which
+          only condor can evaluate; the counts are then incomplete
+    """
+    referenced = sorted({a.lower() for c in constraints for a in c.attributes})
+    ads = schedd.query("true", attributes)
     try:
-        with subprocess.Popen(['condor_q', '-all',
-                               #'-completedsince', str(now - since_insecs),
-                               '-constraint', constraint,
-                               '-format',"%s ", 'Owner',
-                               '-format', "%d.", 'ClusterId',
-                               '-format', "%d ", 'ProcId',
-                               '-format', "%d ", 'RemoteWallClockTime',
-                               '-format', "%s \n", 'JobStatus'],
-                               stdout=subprocess.PIPE) as process:
-            jobs = [dict(zip(keys, [int(x) if i == 2 else (job_st.get(x, "unknown") if i==3 else x)
-                for i,x in enumerate(l.decode("utf-8").split())]))
-                for l in process.stdout.readlines()]
-    except Exception as error:
-        _logger.error(error)
-
-    return jobs
-
-def get_condor_history(job_status=4, since_insecs=360):
-    jobs = []
+        for ad in ads:
+            for name in referenced:
+                if not is_literal(ad.get(name)):
+                    _logger.warning("%s is an expression in some jobs, falling back to "
+                                    "one query per queue", name)
+                    return False
+            for constraint, queue_status in zip(constraints, summery):
+                if constraint.matches(ad):
+                    _count(ad, queue_status)
+    finally:
+        # stop condor_q if we gave up early
+        if hasattr(ads, "close"):
+            ads.close()
+    return True
+
+def get_condor_jobs(timeout=None, schedd=None, resources=False):
+    """yield the jobs in the queue as they are read from the schedd
+
+    Args:
+      timeout (float): seconds after which condor_q is killed
+      schedd: schedd to query, see :func:`get_schedd`
+      resources (bool): add allocated_cores and allocated_mem to each job
+
+    Raises:
+      Exception: the error of a failed query, after the jobs read until then
+    """
+
+    constraint = 'Owner =!= \"{}\"'.format('atlas-coffea')
+    projection = ["Owner", "ClusterId", "ProcId", "RemoteWallClockTime", "JobStatus"]
+    if resources:
+        projection += ["CpusProvisioned", "MemoryProvisioned"]
+    if schedd is None:
+        schedd = get_schedd(timeout=timeout)
+
+    # errors are raised, not swallowed: a partial queue is not a JobTracker snapshot
+    for ad in schedd.query(constraint, projection):
+        job = {"users": ad.get("owner"),
+               "Id": "{}.{}".format(ad.get("clusterid"), ad.get("procid")),
+               "Runtime": int(ad.get("remotewallclocktime", 0)),
+               "state": JOB_STATES.get(ad.get("jobstatus"), "unknown")}
+        if resources:
+            job["allocated_cores"] = int(ad.get("cpusprovisioned", 0))
+            job["allocated_mem"] = int(ad.get("memoryprovisioned", 0))
+        yield job
+
+
+class UserRollup:
+    """UserRollup class aggregates jobs per owner in a single pass
+
+    Runtime percentiles of running jobs are computed from a reservoir sample of
+    at most `samples` runtimes per user, so memory stays bounded.
+    """
+    def __init__(self, samples=1000):
+        self.samples = samples
+        self.users = {}
+
+    def add(self, job):
+        user = self.users.get(job["users"])
+        if user is None:
+            user = self.users[job["users"]] = {"running": 0, "idle": 0, "held": 0, "other": 0,
+                                               "allocated_cores": 0, "allocated_mem": 0,
+                                               "runtime_total": 0, "runtime_max": 0,
+                                               "runtimes": []}
+        state = job["state"]
+        user[state if state in ("running", "idle", "held") else "other"] += 1
+        if state != "running":
+            return
+        user["allocated_cores"] += job.get("allocated_cores", 0)
+        user["allocated_mem"] += job.get("allocated_mem", 0)
+        runtime = job["Runtime"]
+        user["runtime_total"] += runtime
+        user["runtime_max"] = max(user["runtime_max"], runtime)
+        runtimes = user["runtimes"]
+        if len(runtimes) < self.samples:
+            runtimes.append(runtime)
+        else:
+            i = random.randrange(user["running"])
+            if i < self.samples:
+                runtimes[i] = runtime
+
+    def feed(self, jobs):
+        """pass jobs through, adding each of them"""
+        for job in jobs:
+            self.add(job)
+            yield job
+
+    def documents(self):
+        """one dict per user with job counts, resources and runtime percentiles"""
+        for name, user in self.users.items():
+            runtimes = sorted(user.pop("runtimes"))
+            doc = {"users": name}
+            doc.update(user)
+            for p in (50, 90):
+                # nearest rank
+                doc["runtime_p{}".format(p)] = (runtimes[max(0, -(-p * len(runtimes) // 100) - 1)]
+                                                if runtimes else 0)
+            yield doc
+        self.users = {}
+
+class JobTracker(Stateful):
+    """JobTracker class remembers the running jobs already reported, to ship only changes
+
+    A job is reported when it is first seen, when its state changes and every
+    `heartbeat` seconds after that. Every `resync` seconds all jobs are reported.
+    """
+    def __init__(self, state_persistence_file="/run/afmetrics_jobs.json",
+                 heartbeat=3600, resync=86400):
+        self.store = StateStore(state_persistence_file)
+        self.heartbeat = heartbeat
+        self.resync = resync
+        self.restore({})
+
+    def restore(self, data):
+        self.last_resync = data.get("resync", 0)
+        self.jobs = data.get("jobs", {})
+
+    def select(self, jobs, now=None):
+        """yield the jobs that need to be reported, updating the snapshot
+
+        The snapshot is only replaced once jobs is exhausted; if reading the
+        queue fails the previous snapshot is kept, so the next run doesn't
+        report every job as new.
+        """
+        if now is None:
+            now = time.time()
+        full = now - self.last_resync >= self.resync
+        if full:
+            self.last_resync = now
+        selected = 0
+        snapshot = {}
+        for job in jobs:
+            prev = self.jobs.get(job["Id"])
+            if full or prev is None or prev[0] != job["state"] or now - prev[1] >= self.heartbeat:
+                selected += 1
+                snapshot[job["Id"]] = [job["state"], now]
+                yield job
+            else:
+                snapshot[job["Id"]] = prev
+        _logger.debug("reporting %d of %d jobs%s", selected, len(snapshot),
+                      " (full resync)" if full else "")
+        # jobs that left the queue are dropped from the snapshot
+        self.jobs = snapshot
+
+    def save(self):
+        self.store.save({"resync": self.last_resync, "jobs": self.jobs})
+
+
+class HistoryMark(Stateful):
+    """HistoryMark class persists the newest finished job reported by get_condor_history
+
+    The mark is the latest JobFinishedHookDone seen. Jobs finishing within
+    `overlap` seconds before it are remembered by id, so the next query can
+    start a little earlier than the mark without reporting a job twice.
+
+    Jobs of a query are pending until the query finished: the history is read
+    newest first, so moving the mark while reading would skip the older jobs
+    of a query that fails halfway.
+    """
+    def __init__(self, state_persistence_file="/run/afmetrics_condor.json", overlap=120):
+        self.store = StateStore(state_persistence_file)
+        self.overlap = overlap
+        self.restore({})
+
+    def restore(self, data):
+        self.finished = data.get("finished", 0)
+        self.seen = data.get("seen", {})
+        self.pending = {}
+
+    def is_new(self, job_id):
+        return job_id not in self.seen and job_id not in self.pending
+
+    def update(self, job_id, finished):
+        self.pending[job_id] = finished
+
+    def commit(self):
+        """the query finished, move the mark past its jobs"""
+        self.seen.update(self.pending)
+        self.finished = max([self.finished] + list(self.pending.values()))
+        self.pending = {}
+
+    def rollback(self):
+        """the query failed, its jobs are read again next time"""
+        self.pending = {}
+
+    def save(self):
+        cutoff = self.finished - self.overlap
+        self.seen = {k: v for k, v in self.seen.items() if v >= cutoff}
+        self.store.save({"finished": self.finished, "seen": self.seen})
+
+
+def get_condor_history(job_status=4, since_insecs=360, timeout=None, schedd=None,
+                       mark=None, max_lookback=86400):
+    """yield jobs that finished recently
+
+    Args:
+      job_status (int): JobStatus of the jobs to report
+      since_insecs (int): window to query, when there is no mark yet
+      timeout (float): seconds after which condor_history is killed
+      schedd: schedd to query, see :func:`get_schedd`
+      mark (HistoryMark): query only jobs newer than the mark, and advance it
+          once the query finished
+      max_lookback (int): never query further back than this many seconds
+
+    Yields:
+      job: job dict
+
+    Raises:
+      Exception: the error of a failed query, after rolling the mark back
+    """
     now = time.time()
-    keys = ["users", "Id", "Runtime"]
+    if mark is not None:
+        mark.rollback()
+    if mark is not None and mark.finished:
+        start = max(mark.finished - mark.overlap, now - max_lookback)
+    else:
+        start = now - since_insecs
     constraint = 'JobStatus=={} && JobFinishedHookDone>={} && Owner =!= \"{}\"'.format(
-                         job_status, now - since_insecs, 'atlas-coffea')
+                         job_status, start, 'atlas-coffea')
+    # the history is read newest first, stop once we are past the window
+    since = 'JobFinishedHookDone < {}'.format(start - 600) if mark is not None else None
+    if schedd is None:
+        schedd = get_schedd(timeout=timeout)
     try:
-        process = subprocess.Popen(['condor_history',
-                               #'-completedsince', str(now - since_insecs),
-                               '-constraint', constraint,
-                               '-format',"%s ", 'Owner',
-                               '-format', "%d.", 'ClusterId',
-                               '-format', "%d ", 'ProcId',
-                               '-format', "%d \n", 'RemoteWallClockTime'],
-                               stdout=subprocess.PIPE)
-        jobs = [dict(zip(keys, [int(x) if i == 2 else x
-                for i,x in enumerate(l.decode("utf-8").split())]))
-                for l in process.stdout.readlines()]
-
-    except Exception as error:
-        _logger.error(error)
-    return jobs
+        for ad in schedd.history(constraint, ["Owner", "ClusterId", "ProcId",
+                                              "RemoteWallClockTime", "JobFinishedHookDone"],
+                                 since=since):
+            job_id = "{}.{}".format(ad.get("clusterid"), ad.get("procid"))
+            if mark is not None:
+                if not mark.is_new(job_id):
+                    continue
+                mark.update(job_id, ad.get("jobfinishedhookdone", 0))
+            yield {"users": ad.get("owner"),
+                   "Id": job_id,
+                   "Runtime": int(ad.get("remotewallclocktime", 0))}
+
+    except Exception:
+        if mark is not None:
+            mark.rollback()
+        raise
+    if mark is not None:
+        mark.commit()
 
 def main():
     get_condor_queue_summery()
@@ -0,0 +1,345 @@
+"""
+Evaluate condor constraint expressions on job ads client side
+
+This covers the subset of the ClassAd language used in queue constraints:
+literals, attribute references, arithmetic, comparison (including the meta
+operators =?= and =!=), the three valued logical operators, the ternary
+operator and a few common functions. Attribute names are case insensitive and
+string == comparison ignores case, like in condor.
+
+A Constraint that uses anything else raises ValueError when it is parsed, so
+the caller can fall back to letting condor_q evaluate it. The same goes for
+ads whose attributes are unevaluated expressions, see :func:`is_literal`.
+"""
+
+import re
+
+
+class _Undefined:
+    def __repr__(self):
+        return "undefined"
+
+
+class _Error:
+    def __repr__(self):
+        return "error"
+
+
+UNDEFINED = _Undefined()
+ERROR = _Error()
+
+_TOKEN = re.compile(r'''
+    \s*(?:
+      (?P<real>\d+\.\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?|\d+[eE][-+]?\d+)
+     |(?P<int>\d+)
+     |(?P<str>"(?:[^"\\]|\\.)*")
+     |(?P<name>[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)?)
+     |(?P<op>=\?=|=!=|==|!=|<=|>=|&&|\|\||[<>!+\-*/%()?:,])
+    )''', re.VERBOSE)
+
+# binary operators by precedence, lowest first
+_BINARY = [("||",), ("&&",), ("==", "!=", "=?=", "=!=", "is", "isnt"),
+           ("<", "<=", ">", ">="), ("+", "-"), ("*", "/", "%")]
+
+
+def _tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = _TOKEN.match(text, pos)
+        if not match:
+            raise ValueError("cannot parse constraint at: {!r}".format(text[pos:]))
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "int":
+            tokens.append(("lit", int(value)))
+        elif kind == "real":
+            tokens.append(("lit", float(value)))
+        elif kind == "str":
+            tokens.append(("lit", re.sub(r"\\(.)", r"\1", value[1:-1])))
+        elif kind == "name":
+            lower = value.lower()
+            if lower in ("true", "false"):
+                tokens.append(("lit", lower == "true"))
+            elif lower == "undefined":
+                tokens.append(("lit", UNDEFINED))
+            elif lower == "error":
+                tokens.append(("lit", ERROR))
+            elif lower in ("is", "isnt"):
+                tokens.append(("op", lower))
+            else:
+                tokens.append(("name", value))
+        else:
+            tokens.append(("op", value))
+    return tokens
+
+
+def _is_num(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+
+def _truth(v):
+    """map a value to True, False or UNDEFINED/ERROR for the logical operators"""
+    if isinstance(v, bool):
+        return v
+    if _is_num(v):
+        return v != 0
+    if v is UNDEFINED:
+        return UNDEFINED
+    return ERROR
+
+
+def _meta_equal(a, b):
+    if type(a) is not type(b) and not (_is_num(a) and _is_num(b)):
+        return False
+    return a == b
+
+
+def _compare(op, a, b):
+    if a is ERROR or b is ERROR:
+        return ERROR
+    if a is UNDEFINED or b is UNDEFINED:
+        return UNDEFINED
+    if isinstance(a, str) and isinstance(b, str):
+        a, b = a.lower(), b.lower()
+    elif isinstance(a, bool) and isinstance(b, bool):
+        pass
+    elif not (_is_num(a) or isinstance(a, bool)) or not (_is_num(b) or isinstance(b, bool)):
+        return ERROR
+    if op == "==":
+        return a == b
+    if op == "!=":
+        return a != b
+    if op == "<":
+        return a < b
+    if op == "<=":
+        return a <= b
+    if op == ">":
+        return a > b
+    return a >= b
+
+
+def _arith(op, a, b):
+    if a is ERROR or b is ERROR:
+        return ERROR
+    if a is UNDEFINED or b is UNDEFINED:
+        return UNDEFINED
+    if not _is_num(a) or not _is_num(b):
+        return ERROR
+    if op == "+":
+        return a + b
+    if op == "-":
+        return a - b
+    if op == "*":
+        return a * b
+    if b == 0:
+        return ERROR
+    if op == "/":
+        if isinstance(a, int) and isinstance(b, int):
+            return int(a / b)
+        return a / b
+    return a % b
+
+
+def _f_regexp(pattern, target, options=""):
+    if not isinstance(pattern, str) or not isinstance(target, str):
+        return UNDEFINED if UNDEFINED in (pattern, target) else ERROR
+    flags = re.IGNORECASE if "i" in str(options).lower() else 0
+    return re.search(pattern, target, flags) is not None
+
+
+def _f_string_list_member(item, slist, delims=", "):
+    if not isinstance(item, str) or not isinstance(slist, str):
+        return UNDEFINED if UNDEFINED in (item, slist) else ERROR
+    members = [m for m in re.split("[" + re.escape(delims) + "]+", slist) if m]
+    return item in members
+
+
+def _f_to_lower(s):
+    return s.lower() if isinstance(s, str) else (s if s is UNDEFINED else ERROR)
+
+
+def _f_to_upper(s):
+    return s.upper() if isinstance(s, str) else (s if s is UNDEFINED else ERROR)
+
+
+_FUNCTIONS = {
+    "isundefined": lambda v: v is UNDEFINED,
+    "iserror": lambda v: v is ERROR,
+    "isstring": lambda v: isinstance(v, str),
+    "isinteger": lambda v: isinstance(v, int) and not isinstance(v, bool),
+    "isreal": lambda v: isinstance(v, float),
+    "isboolean": lambda v: isinstance(v, bool),
+    "regexp": _f_regexp,
+    "stringlistmember": _f_string_list_member,
+    "tolower": _f_to_lower,
+    "toupper": _f_to_upper,
+    "size": lambda s: len(s) if isinstance(s, str) else (s if s is UNDEFINED else ERROR),
+}
+
+
+def is_literal(value):
+    """False for an attribute value condor left as an expression
+
+    condor_q -json prints those as "/Expr(...)/" strings and the bindings
+    return ExprTree objects; only condor can evaluate them.
+    """
+    if value is None or isinstance(value, (bool, int, float)):
+        return True
+    return isinstance(value, str) and not value.startswith("/Expr(")
+
+
+class Constraint:
+    """Constraint class parses a condor constraint once and evaluates it on many ads"""
+    def __init__(self, text):
+        self.text = text
+        self.attributes = set()
+        self.tokens = _tokenize(text or "true")
+        self.pos = 0
+        self.tree = self._ternary()
+        if self.pos != len(self.tokens):
+            raise ValueError("unexpected {!r} in constraint {!r}".format(
+                self.tokens[self.pos][1], text))
+        del self.tokens
+
+    def __repr__(self):
+        return "Constraint({!r})".format(self.text)
+
+    # ---- parser, builds nested tuples ----
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def _expect(self, op):
+        if self._peek() != ("op", op):
+            raise ValueError("expected {!r} in constraint {!r}".format(op, self.text))
+        self.pos += 1
+
+    def _ternary(self):
+        cond = self._binary(0)
+        if self._peek() == ("op", "?"):
+            self.pos += 1
+            yes = self._ternary()
+            self._expect(":")
+            no = self._ternary()
+            return ("?", cond, yes, no)
+        return cond
+
+    def _binary(self, level):
+        if level == len(_BINARY):
+            return self._unary()
+        left = self._binary(level + 1)
+        while True:
+            kind, value = self._peek()
+            if kind != "op" or value not in _BINARY[level]:
+                return left
+            self.pos += 1
+            left = (value, left, self._binary(level + 1))
+
+    def _unary(self):
+        kind, value = self._peek()
+        if kind == "op" and value in ("!", "-", "+"):
+            self.pos += 1
+            return ("u" + value, self._unary())
+        return self._primary()
+
+    def _primary(self):
+        kind, value = self._peek()
+        self.pos += 1
+        if kind == "lit":
+            return ("lit", value)
+        if kind == "op" and value == "(":
+            expr = self._ternary()
+            self._expect(")")
+            return expr
+        if kind == "name":
+            if self._peek() == ("op", "("):
+                return self._call(value)
+            scope, _, attr = value.rpartition(".")
+            if scope.lower() == "target":
+                return ("lit", UNDEFINED)
+            if scope and scope.lower() != "my":
+                raise ValueError("unsupported scope {!r} in constraint".format(value))
+            self.attributes.add(attr)
+            return ("attr", attr.lower())
+        raise ValueError("unexpected {!r} in constraint {!r}".format(value, self.text))
+
+    def _call(self, name):
+        func = name.lower()
+        self.pos += 1
+        args = []
+        if self._peek() != ("op", ")"):
+            args.append(self._ternary())
+            while self._peek() == ("op", ","):
+                self.pos += 1
+                args.append(self._ternary())
+        self._expect(")")
+        if func == "ifthenelse" and len(args) == 3:
+            return ("?", *args)
+        if func not in _FUNCTIONS:
+            raise ValueError("unsupported function {!r} in constraint".format(name))
+        return ("call", _FUNCTIONS[func], args)
+
+    # ---- evaluation ----
+
+    def evaluate(self, ad):
+        """evaluate on an ad whose keys are lower case attribute names"""
+        return self._eval(self.tree, ad)
+
+    def matches(self, ad):
+        """True if the constraint evaluates to true, like condor_q -constraint"""
+        return _truth(self._eval(self.tree, ad)) is True
+
+    def _eval(self, node, ad):
+        op = node[0]
+        if op == "lit":
+            return node[1]
+        if op == "attr":
+            return ad.get(node[1], UNDEFINED)
+        if op == "call":
+            try:
+                return node[1](*[self._eval(a, ad) for a in node[2]])
+            except TypeError:
+                return ERROR
+        if op == "?":
+            cond = _truth(self._eval(node[1], ad))
+            if cond is True:
+                return self._eval(node[2], ad)
+            if cond is False:
+                return self._eval(node[3], ad)
+            return cond
+        if op == "u!":
+            value = _truth(self._eval(node[1], ad))
+            return (not value) if isinstance(value, bool) else value
+        if op in ("u-", "u+"):
+            value = self._eval(node[1], ad)
+            if _is_num(value):
+                return -value if op == "u-" else value
+            return value if value is UNDEFINED else ERROR
+        if op == "&&":
+            left = _truth(self._eval(node[1], ad))
+            if left is False or left is ERROR:
+                return left
+            right = _truth(self._eval(node[2], ad))
+            if right is False or right is ERROR:
+                return right
+            return UNDEFINED if UNDEFINED in (left, right) else True
+        if op == "||":
+            left = _truth(self._eval(node[1], ad))
+            if left is True or left is ERROR:
+                return left
+            right = _truth(self._eval(node[2], ad))
+            if right is True or right is ERROR:
+                return right
+            return UNDEFINED if UNDEFINED in (left, right) else False
+        left = self._eval(node[1], ad)
+        right = self._eval(node[2], ad)
+        if op in ("=?=", "is"):
+            return _meta_equal(left, right)
+        if op in ("=!=", "isnt"):
+            return not _meta_equal(left, right)
+        if op in ("+", "-", "*", "/", "%"):
+            return _arith(op, left, right)
+        return _compare(op, left, right)
@@ -1,56 +1,219 @@
 """
 Get host metrics: cpu, memory, network and disks
 
-This module persist network stats in a file(memfile, default path: /run/afmetrics.json)
-to help calculate network io metrics
+This module persist network and cpu (/proc/stat) stats in a file(memfile, default path: /run/afmetrics.json)
+to help calculate network io metrics, and disk stats in /run/afmetrics_disks.json
+to calculate disk io rates. Both are read and written once per tick, within a
+:meth:`afmetrics_collector.state.Stateful.transaction`.
 
 """
 
+import fnmatch
 import os
+import re
+import select
+import threading
 import time
 import shutil
-import json
 import socket
+import logging
+from collections import namedtuple
 import psutil
 
-class Xdisks:
-    """A container for disks"""
-    def __init__(self, disks):
-        self.disks = [Xdisk(d) for d in disks]
+from afmetrics_collector.state import Stateful, StateStore
+
+_logger = logging.getLogger(__name__)
+
+# /proc/diskstats counts 512 byte sectors whatever the device block size
+SECTOR_SIZE = 512
+
+
+# ref: https://www.kernel.org/doc/Documentation/ABI/testing/procfs-diskstats
+# 11 fields, 15 since 4.18 (discards) and 17 since 5.5 (flushes)
+DiskStat = namedtuple('DiskStat', ['reads', 'rd_mrg', 'rd_sectors', 'ms_reading',
+                                   'writes', 'wr_mrg', 'wr_sectors', 'ms_writing',
+                                   'cur_ios', 'ms_doing_io', 'ms_weighted',
+                                   'discards', 'dc_mrg', 'dc_sectors', 'ms_discarding',
+                                   'flushes', 'ms_flushing'],
+                      defaults=(0,) * 6)
+
+
+def parse_diskstats(devices, file_path='/proc/diskstats'):
+    """read counters of the given devices in one pass over diskstats
+
+    Args:
+      devices (set): diskstats names of the devices wanted, other lines are skipped
+          without being converted
+      file_path (str): path of the diskstats file
+
+    Returns:
+      stats: dict of device name -> DiskStat
+    """
+    stats = {}
+    with open(file_path, 'r') as f:
+        for line in f:
+            fields = line.split(None, 3)
+            if len(fields) < 4 or fields[2] not in devices:
+                continue
+            values = [int(x) for x in fields[3].split()]
+            if len(values) == 4:
+                # partitions on kernels before 2.6.25: reads, rd_sectors, writes, wr_sectors
+                values = [values[0], 0, values[1], 0, values[2], 0, values[3], 0]
+                values += [0] * 3
+            stats[fields[2]] = DiskStat(*values[:len(DiskStat._fields)])
+    return stats
+
+
+Mount = namedtuple('Mount', ['mountpoint', 'devno', 'fstype', 'source', 'device'])
+
+
+def _unescape(field):
+    # mountinfo escapes space, tab, newline and backslash as \ooo
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+def block_device_name(devno, source=''):
+    """diskstats name of a block device from its major:minor, e.g. sda1 or dm-0
+
+    Returns '' for filesystems without a block device (nfs, tmpfs, ...)
+    """
+    if devno.split(':')[0] != '0':
+        try:
+            # /sys/dev/block/253:0 -> ../../devices/virtual/block/dm-0
+            return os.path.basename(os.readlink('/sys/dev/block/' + devno))
+        except OSError:
+            pass
+    if source.startswith('/dev/'):
+        # resolves /dev/mapper/vg-lv to /dev/dm-0
+        return os.path.basename(os.path.realpath(source))
+    return ''
+
+
+class MountTable:
+    """MountTable class indexes /proc/self/mountinfo by mount point
+
+    The kernel flags the open mountinfo file (POLLPRI) whenever the mount table
+    changes, so it is only parsed again after a change.
+    """
+    def __init__(self, file_path='/proc/self/mountinfo'):
+        self.file_path = file_path
+        self.file = None
+        self.poller = None
+        self.mounts = {}
+        self.refresh(force=True)
+
+    def changed(self):
+        if self.poller is None:
+            return True
+        return bool(self.poller.poll(0))
+
+    def refresh(self, force=False):
+        """re-read the mount table if it changed, returns True if it was read"""
+        if not force and not self.changed():
+            return False
+        if self.file is None:
+            self.file = open(self.file_path, 'r')
+            try:
+                self.poller = select.poll()
+                self.poller.register(self.file, select.POLLPRI | select.POLLERR)
+            except (AttributeError, OSError):
+                # no poll support, re-read every time
+                self.poller = None
+        self.file.seek(0)
+        mounts = {}
+        for line in self.file.read().splitlines():
+            fields = line.split(' ')
+            try:
+                sep = fields.index('-', 6)
+            except ValueError:
+                continue
+            mountpoint = _unescape(fields[4])
+            devno = fields[2]
+            fstype, source = fields[sep + 1], _unescape(fields[sep + 2])
+            # the last mount on a mount point hides the earlier ones
+            mounts[mountpoint] = Mount(mountpoint, devno, fstype, source,
+                                       block_device_name(devno, source))
+        self.mounts = mounts
+        return True
+
+    def lookup(self, path):
+        return self.mounts.get(os.path.normpath(path))
+
+
+_mount_table = None
+
+
+def get_mount_table():
+    """the mount table shared by all disks, refreshed if the mounts changed"""
+    global _mount_table
+    if _mount_table is None:
+        _mount_table = MountTable()
+    else:
+        _mount_table.refresh()
+    return _mount_table
+
+
+class Xdisks(Stateful):
+    """A container for disks
+
+    Previous /proc/diskstats counters are persisted in a file (default path:
+    /run/afmetrics_disks.json) so each run can report io rates since the last one.
+    """
+    def __init__(self, disks, state_persistence_file="/run/afmetrics_disks.json"):
+        self.mount_table = get_mount_table()
+        self.disks = [Xdisk(d, mount_table=self.mount_table) for d in disks]
+        self.store = StateStore(state_persistence_file)
         self.last_update = None
+        self.index()
         #self.update()
 
+    def restore(self, data):
+        self.last_update = data.get("timestamp")
+        for disk in self.disks:
+            disk.iostat_previous = {}
+        try:
+            for device, values in data.get("devices", {}).items():
+                for disk in self.by_device.get(device, ()):
+                    disk.iostat_previous = DiskStat(*values)
+        except TypeError:
+            pass
+
+    def index(self):
+        # several mounts (bind mounts) can share a device
+        self.by_device = {}
+        for disk in self.disks:
+            if disk.device:
+                self.by_device.setdefault(disk.device, []).append(disk)
+
     def update(self):
-        file_path = '/proc/diskstats'
-        # ref: http://lxr.osuosl.org/source/Documentation/iostats.txt
-        columns_disk = ['m', 'mm', 'dev', 'reads', 'rd_mrg', 'rd_sectors',
-                        'ms_reading', 'writes', 'wr_mrg', 'wr_sectors',
-                        'ms_writing', 'cur_ios', 'ms_doing_io', 'ms_weighted']
-        lines = open(file_path, 'r').readlines()
-        self.last_update = time.time()
-        for line in lines:
-            if line == '':
-                continue
-            split = line.split()
-            if len(split) != len(columns_disk):
-                continue
-            data = dict(zip(columns_disk, split))
-            # change values to ints.
-            for key in data:
-                if key != 'dev':
-                    data[key] = int(data[key])
-            # get Xdisk with this data['dev'] device and set values
+        if self.mount_table.refresh():
             for disk in self.disks:
-                if disk.device == data['dev']:
-                    if self.last_update and disk.iostat_previous:
-                        for k in data:
-                            if k == 'dev':
-                                continue
-                            disk.iostat[k] = data[k] - disk.iostat_previous[k]
-                        # this is not incremented
-                        disk.iostat['cur_ios'] = data['cur_ios']
-                    disk.iostat_previous = data
-                    break
+                disk.set_device()
+            self.index()
+        stats = parse_diskstats(self.by_device)
+        now = time.time()
+        interval = now - self.last_update if self.last_update else 0
+        for device, data in stats.items():
+            for disk in self.by_device[device]:
+                disk.iostat = {}
+                # samples older than an hour are not worth a rate
+                if 0 < interval <= 3600 and disk.iostat_previous:
+                    disk.iostat = io_rates(disk.iostat_previous, data, interval)
+                disk.iostat_previous = data
+        self.last_update = now
+
+        self.store.save({"timestamp": now, "devices": stats})
+
+    def sample_usage(self, timeout=10):
+        """statvfs every disk once for this tick, in parallel
+
+        A disk whose statvfs doesn't return within timeout seconds (hung nfs
+        or lustre server) is marked stalled instead of blocking the collection.
+        """
+        threads = [(disk, disk.start_usage()) for disk in self.disks]
+        deadline = time.monotonic() + timeout
+        for disk, thread in threads:
+            disk.finish_usage(thread, max(0, deadline - time.monotonic()))
 
     def report(self):
         for disk in self.disks:
@@ -58,124 +221,380 @@ class Xdisks:
         print('--------------------------------------')
 
 
+def io_rates(prev, cur, interval):
+    """per second io rates between two DiskStat samples taken interval seconds apart"""
+    delta = DiskStat._make(c - p for c, p in zip(cur, prev))
+    if any(v < 0 for i, v in enumerate(delta) if i != DiskStat._fields.index('cur_ios')):
+        # counters went backwards: device was reset or replaced
+        return {}
+    ios = delta.reads + delta.writes
+    return {'interval': round(interval, 3),
+            'read_iops': delta.reads / interval,
+            'write_iops': delta.writes / interval,
+            'read_bytes_per_sec': delta.rd_sectors * SECTOR_SIZE / interval,
+            'write_bytes_per_sec': delta.wr_sectors * SECTOR_SIZE / interval,
+            # share of the interval the device was busy
+            'io_utilization': min(1.0, delta.ms_doing_io / (interval * 1000)),
+            'await_ms': (delta.ms_reading + delta.ms_writing) / ios if ios else 0.0,
+            'queue_depth': delta.ms_weighted / (interval * 1000),
+            'cur_ios': cur.cur_ios}
+
+
 class Xdisk:
     """Xdisk class implments disk metrics collections"""
-    def __init__(self, path, lwm=0.95, hwm=0.98):
+    def __init__(self, path, lwm=0.95, hwm=0.98, mount_table=None):
         self.path = path
         self.lwm = lwm
         self.hwm = hwm
+        self.mount_table = mount_table
         self.device = ''
+        self.fstype = ''
         self.iostat_previous = {}
         self.iostat = {}
+        # disk usage of the current tick, see sample_usage
+        self.usage = None
+        self.usage_error = None
+        self.stalled = False
+        self._statvfs = None
         self.set_device()
 
     def __str__(self):
         res = '{:20} device: {:10} used: {}% '.format(
-            self.path, self.device, int(self.get_utilization() * 100))
+            self.path, self.device, int(self.get_utilization()[3] * 100))
         for k, v in self.iostat.items():
             res += k + ':' + str(v)+' '
         return res
 
+    def start_usage(self):
+        """start a statvfs of the mount in a thread, unless the last one is still hung"""
+        if self._statvfs is not None and self._statvfs.is_alive():
+            return None
+        result = {}
+
+        def statvfs():
+            try:
+                result['usage'] = shutil.disk_usage(self.path)
+            except OSError as error:
+                result['error'] = error
+
+        thread = threading.Thread(target=statvfs, name="statvfs " + self.path, daemon=True)
+        thread.result = result
+        thread.start()
+        self._statvfs = thread
+        return thread
+
+    def finish_usage(self, thread, timeout):
+        self.usage = None
+        self.usage_error = None
+        if thread is not None:
+            thread.join(timeout)
+        self.stalled = thread is None or thread.is_alive()
+        if self.stalled:
+            _logger.warning("statvfs of %s did not return in time", self.path)
+            return
+        self.usage = thread.result.get('usage')
+        self.usage_error = thread.result.get('error')
+
+    def sample_usage(self, timeout=10):
+        self.finish_usage(self.start_usage(), timeout)
+
     def get_space(self):
-        return shutil.disk_usage(self.path)
+        if self.usage is None:
+            self.sample_usage()
+        if self.usage is None:
+            raise self.usage_error or TimeoutError("statvfs of {} stalled".format(self.path))
+        return self.usage
 
     def get_utilization(self):
-        (total, used, free) = shutil.disk_usage(self.path)
+        (total, used, free) = self.get_space()
         return (total, used, free, used / total)
 
     def get_free_space(self):
-        (total, used, free) = shutil.disk_usage(self.path)
+        (total, used, free) = self.get_space()
         return free
 
     def set_device(self):
-        file_path = '/etc/mtab'
-        lines = open(file_path, 'r').readlines()
-        for line in lines:
-            if line == '':
-                continue
-            w = line.split(' ')
-            if w[1] == self.path:
-                self.device = w[0].replace('/dev/', '')
+        if self.mount_table is None:
+            self.mount_table = get_mount_table()
+        mount = self.mount_table.lookup(self.path)
+        if mount is None:
+            self.device, self.fstype = '', ''
+            return
+        if mount.device != self.device:
+            # don't compute rates across different devices
+            self.iostat_previous = {}
+        self.device, self.fstype = mount.device, mount.fstype
+
+
+# ref: https://www.kernel.org/doc/html/latest/filesystems/proc.html#miscellaneous-kernel-statistics-in-proc-stat
+CPU_FIELDS = ['user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq', 'steal']
+
+# a core busier than this over the interval counts as saturated
+CPU_SATURATED = 90.0
+
+
+def parse_proc_stat(file_path='/proc/stat'):
+    """jiffies spent in each state, for all cpus ("cpu") and each core ("cpuN")"""
+    stats = {}
+    with open(file_path, "r") as f:
+        for line in f:
+            if not line.startswith("cpu"):
+                # the cpu lines come first
                 break
+            fields = line.split()
+            # guest time is already counted in user and nice
+            stats[fields[0]] = [int(v) for v in fields[1:len(CPU_FIELDS) + 1]]
+    return stats
+
+
+def cpu_percent(prev, cur):
+    """share of the jiffies between two samples spent in each state, in percent"""
+    delta = [c - p for c, p in zip(cur, prev)]
+    total = sum(delta)
+    if total <= 0 or any(v < 0 for v in delta):
+        return None
+    return {field: 100.0 * v / total for field, v in zip(CPU_FIELDS, delta)}
+
+
+def cpu_usage(prev, cur):
+    """utilization breakdown and per core saturation between two /proc/stat samples
+
+    Args:
+      prev (dict): previous :func:`parse_proc_stat` result
+      cur (dict): current :func:`parse_proc_stat` result
+
+    Returns:
+      usage: dict of percentages, empty if there is no usable previous sample
+    """
+    if "cpu" not in prev or "cpu" not in cur:
+        return {}
+    pct = cpu_percent(prev["cpu"], cur["cpu"])
+    if pct is None:
+        return {}
+    usage = {'user': pct['user'] + pct['nice'],
+             'system': pct['system'] + pct['irq'] + pct['softirq'],
+             'iowait': pct['iowait'],
+             'steal': pct['steal'],
+             'idle': pct['idle']}
+    busy = []
+    for name, counters in cur.items():
+        # cores that went offline or came online in between are skipped
+        if name != "cpu" and name in prev:
+            core = cpu_percent(prev[name], counters)
+            if core is not None:
+                busy.append(100.0 - core['idle'] - core['iowait'])
+    if busy:
+        usage['cores'] = len(busy)
+        usage['busiest_core'] = max(busy)
+        usage['saturated_cores'] = sum(1 for b in busy if b >= CPU_SATURATED)
+    return usage
+
+
+def parse_pressure(resources=('cpu', 'io', 'memory'), dir_path='/proc/pressure'):
+    """pressure stall averages, e.g. {'cpu_some_avg10': 0.5, ...}
+
+    Needs a kernel with PSI (4.20+, enabled); missing resources are left out.
+    """
+    pressure = {}
+    for resource in resources:
+        try:
+            with open(os.path.join(dir_path, resource), "r") as f:
+                lines = f.readlines()
+        except OSError:
+            continue
+        for line in lines:
+            kind, *values = line.split()
+            for value in values:
+                key, _, number = value.partition("=")
+                if key.startswith("avg"):
+                    pressure["{}_{}_{}".format(resource, kind, key)] = float(number)
+    return pressure
+
 
+NIC_COUNTERS = ['bytes_sent', 'bytes_recv', 'packets_sent', 'packets_recv',
+                'errin', 'errout', 'dropin', 'dropout']
 
-class XNode:
+
+def counter_delta(prev, cur):
+    """increase of a counter, allowing for a reset to zero
+
+    The kernel counters read by psutil are 64 bit, so a decrease is a reset
+    (driver reload, interface recreated) rather than a wrap.
+    """
+    if cur >= prev:
+        return cur - prev
+    return cur
+
+
+class XNode(Stateful):
     """XNode class implments node metrics collections"""
     def __init__(self, state_persistence_file="/run/afmetrics.json"):
-        self.state_persistence_file = state_persistence_file
-        try:
-            file_p = open(state_persistence_file, "r")
-            self.data_prev = json.load(file_p)
-            file_p.close()
-        except:
-            self.data_prev = {}
+        self.store = StateStore(state_persistence_file)
+        self.restore({})
 
+    def restore(self, data):
+        self.nics = None
         timestamp = int(time.time() * 1000)
-        if self.data_prev.get("timestamp", 0) < timestamp - 3600*1000:
-            with open(state_persistence_file, "w") as f:
-                net_io = psutil.net_io_counters()
-                self.data_prev = {'sent' : net_io.bytes_sent,
-                                  'received' : net_io.bytes_recv,
-                                  'timestamp': int(time.time() * 1000)}
-                jdata=json.dumps(self.data_prev)
-                f.write(jdata)
-
+        if data.get("timestamp", 0) < timestamp - 3600*1000:
+            # no usable previous sample, rates start from the next run
+            data = {}
+        self.data_prev = data
+        self.data_cur = dict(data)
 
     def get_load(self):
         return os.getloadavg()  # 1, 5, 15 min
 
+    def sample_cpu(self):
+        try:
+            self.data_cur['cpu'] = parse_proc_stat()
+        except OSError as error:
+            _logger.error("cannot read cpu stats: %s", error)
+            self.data_cur['cpu'] = {}
+
+    def get_cpu(self):
+        """cpu utilization since the previous sample, see :func:`cpu_usage`"""
+        self.sample_cpu()
+        return cpu_usage(self.data_prev.get('cpu', {}), self.data_cur['cpu'])
+
     def get_memory(self):
         mem = psutil.virtual_memory()
         return mem.total, mem.available
 
+    def sample_network(self):
+        """read the counters of all interfaces once for this tick"""
+        self.nics = psutil.net_io_counters(pernic=True)
+        self.data_cur.update({'sent': sum(n.bytes_sent for n in self.nics.values()),
+                              'received': sum(n.bytes_recv for n in self.nics.values()),
+                              'timestamp': int(time.time() * 1000),
+                              'interfaces': {name: list(n) for name, n in self.nics.items()}})
+
     def get_network(self):
-        net_io = psutil.net_io_counters()
-        timestamp = int(time.time() * 1000)
+        """bytes sent and received since the previous sample, None without one"""
+        self.sample_network()
+        if "timestamp" not in self.data_prev:
+            return None
         res = {
-            'sent': net_io.bytes_sent - self.data_prev["sent"],
-            'received': net_io.bytes_recv - self.data_prev["received"],
-            'interval': (timestamp - self.data_prev["timestamp"])/1000
+            'sent': self.data_cur["sent"] - self.data_prev["sent"],
+            'received': self.data_cur["received"] - self.data_prev["received"],
+            'interval': (self.data_cur["timestamp"] - self.data_prev["timestamp"])/1000
         }
-        mydata = {'sent' : net_io.bytes_sent,
-                  'received' : net_io.bytes_recv,
-                  'timestamp': timestamp}
-        jdata=json.dumps(mydata)
-        with open(self.state_persistence_file,"w") as f:
-            f.write(jdata)
-
         return res
 
+    def get_interfaces(self, include=["*"], exclude=["lo"]):
+        """per interface rates of bytes, packets, errors and drops since the last sample
+
+        Args:
+          include (list): fnmatch patterns of the interfaces to report
+          exclude (list): fnmatch patterns of interfaces not to report
+
+        Returns:
+          interfaces: list of dicts, one per interface seen in both samples
+        """
+        if self.nics is None:
+            self.sample_network()
+        interval = (self.data_cur["timestamp"] - self.data_prev.get("timestamp", 0)) / 1000
+        prev_nics = self.data_prev.get("interfaces", {})
+        res = []
+        for name, counters in sorted(self.nics.items()):
+            if not any(fnmatch.fnmatchcase(name, p) for p in include) or \
+                    any(fnmatch.fnmatchcase(name, p) for p in exclude):
+                continue
+            prev = prev_nics.get(name)
+            if prev is None or interval <= 0:
+                # new interface, rates from the next sample on
+                continue
+            rec = {'interface': name, 'interval': interval}
+            for key, p, c in zip(NIC_COUNTERS, prev, counters):
+                rec[key + '_per_sec'] = counter_delta(p, c) / interval
+            res.append(rec)
+        return res
 
-def get_host_metrics(header={}, disks=["/home", "/data", "/scratch"]):
-
-    xd = Xdisks(disks)
-    no = XNode()
+    def save(self):
+        """persist the current sample, it becomes the previous one"""
+        self.store.save(self.data_cur)
+        # keep the sample so a long running process reports per interval deltas
+        self.data_prev = self.data_cur
+        self.data_cur = dict(self.data_cur)
+        self.nics = None
+
+
+def get_host_metrics(header={}, disks=["/home", "/data", "/scratch"], xd=None, no=None,
+                     disk_timeout=10, nics_include=["*"], nics_exclude=["lo"]):
+    """collect cpu, memory, network and disk documents
+
+    Args:
+      header (dict): fields copied into every document
+      disks (list): mount points to report, ignored if xd is given
+      xd (Xdisks): disks to reuse between calls (daemon mode)
+      no (XNode): node to reuse between calls (daemon mode)
+      disk_timeout (float): seconds to wait for the statvfs of all disks
+      nics_include (list): fnmatch patterns of the interfaces to report
+      nics_exclude (list): fnmatch patterns of interfaces not to report
+
+    Returns:
+      data: list of documents
+    """
+
+    if xd is None:
+        xd = Xdisks(disks)
+    if no is None:
+        no = XNode()
 
     data = []
 
-    load_rec = header.copy()
-    load_rec['kind'] = "CPU"
-    (load_rec['load'], *rest) = no.get_load()
-    data.append(load_rec)
-
-    mem_rec = header.copy()
-    mem_rec['kind'] = "MEM"
-    (mem_rec['total'], mem_rec['available']) =  no.get_memory()
-    data.append(mem_rec)
-
-    netw_rec = header.copy()
-    netw_rec['kind'] = "NETWORK"
-    netw_rec['network'] = no.get_network()
-    data.append(netw_rec)
+    # the previous samples stay locked until the new ones are saved
+    with no.transaction():
+        load_rec = header.copy()
+        load_rec['kind'] = "CPU"
+        (load_rec['load'], load_rec['load5'], load_rec['load15']) = no.get_load()
+        for k, v in no.get_cpu().items():
+            load_rec[k] = v
+        pressure = parse_pressure()
+        if pressure:
+            load_rec['pressure'] = pressure
+        data.append(load_rec)
+
+        mem_rec = header.copy()
+        mem_rec['kind'] = "MEM"
+        (mem_rec['total'], mem_rec['available']) =  no.get_memory()
+        data.append(mem_rec)
+
+        network = no.get_network()
+        if network is not None:
+            netw_rec = header.copy()
+            netw_rec['kind'] = "NETWORK"
+            netw_rec['network'] = network
+            data.append(netw_rec)
+
+        for nic in no.get_interfaces(include=nics_include, exclude=nics_exclude):
+            nic_rec = header.copy()
+            nic_rec['kind'] = "NETIF"
+            nic_rec.update(nic)
+            data.append(nic_rec)
+        no.save()
+
+    with xd.transaction():
+        try:
+            xd.update()
+        except OSError as error:
+            _logger.error("cannot read disk io stats: %s", error)
+    xd.sample_usage(timeout=disk_timeout)
 
     for disk in xd.disks:
         disk_rec = header.copy()
         disk_rec['kind'] = "DISK"
         if disk.device:
             disk_rec['device'] = disk.device
+        if disk.fstype:
+            disk_rec['fstype'] = disk.fstype
         disk_rec['mount'] = disk.path
-        (disk_rec['total'], disk_rec['used'], disk_rec['free'], \
-                disk_rec["utilization"]) = disk.get_utilization()
+        if disk.stalled:
+            disk_rec['stalled'] = True
+        elif disk.usage is None:
+            _logger.error("cannot get disk usage of %s: %s", disk.path, disk.usage_error)
+        else:
+            (disk_rec['total'], disk_rec['used'], disk_rec['free'], \
+                    disk_rec["utilization"]) = disk.get_utilization()
         for k, v in disk.iostat.items():
             disk_rec[k] = v
         data.append(disk_rec)
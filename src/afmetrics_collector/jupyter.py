@@ -2,42 +2,306 @@
 Allows you to pick a context and then lists all pods in the chosen context. A
 context includes a cluster, a user, and a namespace.
 Please install the pick library before running this example.
+
+Long running collectors use a :class:`PodCache` instead: the pods are listed
+once and then followed with a watch, so each run reads the users from memory.
+
+:func:`get_jupyter_usage` joins the requests and limits of the running pods
+with their live usage from the metrics.k8s.io api (metrics-server).
 """
 
 
+import json
 import logging
+import threading
 
-from kubernetes import client, config
+from kubernetes import client, config, watch
+from kubernetes.client.rest import ApiException
+from kubernetes.utils import parse_quantity
 #from kubernetes.client import configuration
 
 _logger = logging.getLogger(__name__)
 
+_api = None
+
+
+def get_api():
+    """load the kube config once and return a shared CoreV1Api client"""
+    global _api
+    if _api is None:
+        # Configs can be set in Configuration class directly or using helper utility
+        config.load_kube_config()
+        _api = client.CoreV1Api()
+    return _api
+
+
+# only the metadata of the pods, falling back to full pods on old apiservers
+METADATA_LIST = "application/json;as=PartialObjectMetadataList;g=meta.k8s.io;v=v1,application/json"
+METADATA = "application/json;as=PartialObjectMetadata;g=meta.k8s.io;v=v1,application/json"
+RUNNING = "status.phase=Running"
+
 
-def get_jupyter_users(namespace, label):
+def list_pods(api, namespace, label, field_selector=RUNNING, limit=500, timeout=None,
+              accept="application/json"):
+    """list pods as dicts, limit pods per request
+
+    Args:
+      api (CoreV1Api): kubernetes client
+      namespace (str): namespace
+      label (str): label selector
+      field_selector (str): field selector, running pods by default
+      limit (int): maximum number of pods per page
+      timeout (float): timeout in seconds of each page request
+      accept (str): Accept header, see METADATA_LIST
+
+    Returns:
+      pods, resource_version: list of pod dicts, and the version of the list
+    """
+    pods = []
+    resource_version = None
+    _continue = None
+    while True:
+        resp = api.list_namespaced_pod(namespace, label_selector=label,
+                                       field_selector=field_selector, limit=limit,
+                                       _continue=_continue, _preload_content=False,
+                                       _request_timeout=timeout,
+                                       _headers={"Accept": accept})
+        page = json.loads(resp.data)
+        pods.extend(page["items"])
+        # all pages are of the snapshot of the first one
+        if resource_version is None:
+            resource_version = page["metadata"].get("resourceVersion")
+        _continue = page["metadata"].get("continue")
+        if not _continue:
+            return pods, resource_version
+
+
+def list_pod_metadata(api, namespace, label, field_selector=RUNNING, limit=500, timeout=None):
+    """list the metadata of pods, see :func:`list_pods`
+
+    Returns:
+      pods, resource_version: list of pod metadata dicts, and the version of the list
+    """
+    pods, resource_version = list_pods(api, namespace, label, field_selector, limit, timeout,
+                                       accept=METADATA_LIST)
+    return [pod["metadata"] for pod in pods], resource_version
+
+
+def get_jupyter_users(namespace, label, timeout=None):
     """get list of users running jupyter notebooks
 
     Args:
       namespace (str): namespace
       label (str): the name of label of ownership
+      timeout (float): timeout in seconds of the api request
 
     Returns:
       users: list of users
     """
 
-    # Configs can be set in Configuration class directly or using helper utility
-    config.load_kube_config()
-
-    v1 = client.CoreV1Api()
+    v1 = get_api()
     _logger.debug("Listing pods:")
-    ret = v1.list_namespaced_pod(namespace, label_selector=label)
-    for i in ret.items:
-        _logger.debug("%s\t%s\t%s", i.status.pod_ip, i.metadata.namespace, i.metadata.name)
-    users = []
-    any(users.append(i.metadata.labels[label]) for i in ret.items
-            if i.metadata.labels[label] not in users)
+    pods, _ = list_pod_metadata(v1, namespace, label, timeout=timeout)
+    for pod in pods:
+        _logger.debug("%s\t%s", pod["namespace"], pod["name"])
+    # set based dedup, keeping the order of the pods
+    users = list(dict.fromkeys(pod["labels"][label] for pod in pods))
     _logger.debug("users:%s", users)
     return users
 
+GPU_RESOURCES = ("nvidia.com/gpu", "amd.com/gpu")
+
+
+def _resources(container, kind):
+    """cpu (cores), memory (bytes) and gpus of the requests or limits of a container"""
+    values = (container.get("resources") or {}).get(kind) or {}
+    return (float(parse_quantity(values.get("cpu", 0))),
+            float(parse_quantity(values.get("memory", 0))),
+            sum(int(parse_quantity(values[gpu])) for gpu in GPU_RESOURCES if gpu in values))
+
+
+def get_jupyter_usage(namespace, label, timeout=None, api=None):
+    """get cpu and memory usage, requests and limits of the users running jupyter notebooks
+
+    The pods come from one list and their usage from one metrics.k8s.io query
+    of the namespace. Efficiencies are usage over requests of the pods that
+    have metrics; pods that just started have none yet.
+
+    Args:
+      namespace (str): namespace
+      label (str): the name of label of ownership
+      timeout (float): timeout in seconds of each api request
+      api (CoreV1Api): kubernetes client, the shared one by default
+
+    Returns:
+      usage: list of dicts, one per user
+    """
+    if api is None:
+        api = get_api()
+    pods, _ = list_pods(api, namespace, label, timeout=timeout)
+    metrics = client.CustomObjectsApi(api.api_client).list_namespaced_custom_object(
+        "metrics.k8s.io", "v1beta1", namespace, "pods", label_selector=label,
+        _request_timeout=timeout)
+    used = {}
+    for item in metrics["items"]:
+        cpu = memory = 0.0
+        for container in item["containers"]:
+            cpu += float(parse_quantity(container["usage"]["cpu"]))
+            memory += float(parse_quantity(container["usage"]["memory"]))
+        used[item["metadata"]["name"]] = (cpu, memory)
+
+    users = {}
+    for pod in pods:
+        owner = pod["metadata"]["labels"][label]
+        user = users.get(owner)
+        if user is None:
+            user = users[owner] = dict.fromkeys(
+                ["pods", "cpu_usage", "memory_usage", "cpu_request", "memory_request",
+                 "gpu_request", "cpu_limit", "memory_limit", "gpu_limit",
+                 "measured_cpu_request", "measured_memory_request"], 0)
+            user["user"] = owner
+        user["pods"] += 1
+        requests = [0.0, 0.0, 0]
+        for container in pod["spec"]["containers"]:
+            for i, v in enumerate(_resources(container, "requests")):
+                requests[i] += v
+            cpu, memory, gpu = _resources(container, "limits")
+            user["cpu_limit"] += cpu
+            user["memory_limit"] += memory
+            user["gpu_limit"] += gpu
+        user["cpu_request"] += requests[0]
+        user["memory_request"] += requests[1]
+        user["gpu_request"] += requests[2]
+        if pod["metadata"]["name"] in used:
+            cpu, memory = used[pod["metadata"]["name"]]
+            user["cpu_usage"] += cpu
+            user["memory_usage"] += memory
+            user["measured_cpu_request"] += requests[0]
+            user["measured_memory_request"] += requests[1]
+
+    usage = []
+    for user in users.values():
+        cpu_request = user.pop("measured_cpu_request")
+        memory_request = user.pop("measured_memory_request")
+        if cpu_request:
+            user["cpu_efficiency"] = user["cpu_usage"] / cpu_request
+        if memory_request:
+            user["memory_efficiency"] = user["memory_usage"] / memory_request
+        usage.append(user)
+    _logger.debug("usage of %d pods of %d users, %d with metrics", len(pods), len(usage),
+                  len(used))
+    return sorted(usage, key=lambda u: u["user"])
+
+
+class PodCache:
+    """PodCache class keeps an owner -> pods index of the labeled pods of a namespace
+
+    The index is built from one list of the running pods and kept up to date by
+    a watch resumed from the last resourceVersion seen; pods that stop running
+    are deleted from the watch. When the apiserver no
+    longer has that version (410 Gone) the pods are listed again.
+    """
+    def __init__(self, namespace, label, api=None, watch_timeout=300, timeout=None):
+        self.namespace = namespace
+        self.label = label
+        self.api = api
+        self.watch_timeout = watch_timeout
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pods = {}
+        self.owners = {}
+        self.resource_version = None
+        self.synced = threading.Event()
+        self.stopped = threading.Event()
+        self.watcher = None
+        self.thread = None
+
+    def start(self):
+        if self.api is None:
+            self.api = get_api()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name="pods-" + self.namespace)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.watcher is not None:
+            self.watcher.stop()
+
+    def users(self, timeout=None):
+        """owners of the pods, waiting at most timeout seconds for the first list"""
+        if not self.synced.wait(timeout):
+            raise TimeoutError("pods of {} not listed yet".format(self.namespace))
+        with self.lock:
+            return list(self.owners)
+
+    def _add(self, name, owner):
+        self.pods[name] = owner
+        self.owners.setdefault(owner, set()).add(name)
+
+    def _remove(self, name):
+        owner = self.pods.pop(name, None)
+        if owner is not None:
+            self.owners[owner].discard(name)
+            if not self.owners[owner]:
+                del self.owners[owner]
+
+    def relist(self):
+        pods, resource_version = list_pod_metadata(self.api, self.namespace, self.label,
+                                                   timeout=self.timeout)
+        with self.lock:
+            self.pods = {}
+            self.owners = {}
+            for pod in pods:
+                self._add(pod["name"], pod["labels"][self.label])
+        self.resource_version = resource_version
+        self.synced.set()
+        _logger.debug("listed %d pods of %d users in %s at version %s", len(self.pods),
+                      len(self.owners), self.namespace, self.resource_version)
+
+    def follow(self):
+        self.watcher = watch.Watch()
+        for event in self.watcher.stream(self.api.list_namespaced_pod, self.namespace,
+                                         label_selector=self.label,
+                                         field_selector=RUNNING,
+                                         resource_version=self.resource_version,
+                                         allow_watch_bookmarks=True,
+                                         timeout_seconds=self.watch_timeout,
+                                         _headers={"Accept": METADATA}):
+            pod = event['object']
+            if event['type'] != 'BOOKMARK':
+                with self.lock:
+                    self._remove(pod.metadata.name)
+                    if event['type'] != 'DELETED':
+                        self._add(pod.metadata.name, pod.metadata.labels[self.label])
+            self.resource_version = self.watcher.resource_version
+            if self.stopped.is_set():
+                break
+
+    def run(self):
+        delay = 1
+        while not self.stopped.is_set():
+            try:
+                if self.resource_version is None:
+                    self.relist()
+                # returns after watch_timeout, to be resumed
+                self.follow()
+                delay = 1
+                continue
+            except ApiException as error:
+                if error.status == 410:
+                    _logger.info("pod watch of %s expired, listing again", self.namespace)
+                    self.resource_version = None
+                    continue
+                _logger.error(error)
+            except Exception as error:
+                _logger.error(error)
+            # apiserver unreachable, retry with backoff
+            self.stopped.wait(delay)
+            delay = min(delay * 2, 60)
+
+
 def main():
     get_jupyter_users("af-jupyter", "owner")
 
@@ -0,0 +1,144 @@
+"""
+Attribute cpu, memory and io of the processes on a node to their users
+
+/proc is walked once per tick: the owner of each process is the owner of its
+/proc/<pid> directory, cpu time and rss come from /proc/<pid>/stat and storage
+io from /proc/<pid>/io (only readable for other users' processes as root).
+Cpu time and io are counters, so the per process values of the previous tick
+are persisted (default path: /run/afmetrics_procs.json) to report usage over
+the interval. Usage of processes that exited during the interval is not seen.
+"""
+
+import functools
+import logging
+import os
+import pwd
+
+from afmetrics_collector.state import Stateful, StateStore
+
+_logger = logging.getLogger(__name__)
+
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+@functools.lru_cache(maxsize=4096)
+def user_name(uid):
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return str(uid)
+
+
+def read_uptime(proc_path="/proc"):
+    with open(os.path.join(proc_path, "uptime"), "r") as f:
+        return float(f.read().split()[0])
+
+
+def read_process(pid_path):
+    """(uid, start ticks, cpu ticks, rss bytes, read bytes, write bytes) of one process
+
+    Returns None if the process exited while it was read.
+    """
+    try:
+        uid = os.stat(pid_path).st_uid
+        with open(os.path.join(pid_path, "stat"), "rb") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # the command name in parentheses may contain spaces and parentheses
+    fields = stat[stat.rfind(b")") + 2:].split()
+    # fields counted from state (field 3 in proc(5))
+    cpu = int(fields[11]) + int(fields[12])
+    start = int(fields[19])
+    rss = int(fields[21]) * PAGE_SIZE
+    read_bytes = write_bytes = 0
+    try:
+        with open(os.path.join(pid_path, "io"), "rb") as f:
+            for line in f:
+                if line.startswith(b"read_bytes:"):
+                    read_bytes = int(line.split()[1])
+                elif line.startswith(b"write_bytes:"):
+                    write_bytes = int(line.split()[1])
+    except OSError:
+        # not our process and not root, or exited
+        pass
+    return uid, start, cpu, rss, read_bytes, write_bytes
+
+
+class UserUsage(Stateful):
+    """UserUsage class sums the cpu, memory and io of processes per user between ticks"""
+    def __init__(self, state_persistence_file="/run/afmetrics_procs.json",
+                 min_uid=1000, proc_path="/proc"):
+        self.store = StateStore(state_persistence_file)
+        self.min_uid = min_uid
+        self.proc_path = proc_path
+        self.procs = {}
+        self.uptime = None
+        self.restore({})
+
+    def restore(self, data):
+        self.uptime_prev = data.get("uptime")
+        self.procs_prev = data.get("procs", {})
+
+    def sample(self):
+        """usage per user since the previous sample, busiest users first
+
+        Returns:
+          usage: list of dicts with user, processes, cpu (in cores), rss (bytes),
+          read_bytes_per_sec and write_bytes_per_sec; rates are left out without
+          a previous sample
+        """
+        self.uptime = read_uptime(self.proc_path)
+        interval = self.uptime - self.uptime_prev if self.uptime_prev else 0
+        # a reboot restarts the uptime and every counter
+        rates = 0 < interval <= 3600
+        users = {}
+        self.procs = {}
+        for pid in os.listdir(self.proc_path):
+            if not pid.isdigit():
+                continue
+            proc = read_process(os.path.join(self.proc_path, pid))
+            if proc is None or proc[0] < self.min_uid:
+                continue
+            uid, start, cpu, rss, read_bytes, write_bytes = proc
+            self.procs[pid] = [start, cpu, read_bytes, write_bytes]
+            user = users.get(uid)
+            if user is None:
+                user = users[uid] = {"processes": 0, "rss": 0, "cpu": 0,
+                                     "read_bytes": 0, "write_bytes": 0}
+            user["processes"] += 1
+            user["rss"] += rss
+            if not rates:
+                continue
+            prev = self.procs_prev.get(pid)
+            if prev is not None and prev[0] == start:
+                prev_cpu, prev_read, prev_write = prev[1:]
+            elif start / CLK_TCK >= self.uptime_prev:
+                # started since the previous sample, all of its usage is new
+                prev_cpu = prev_read = prev_write = 0
+            else:
+                # missed by the previous sample, its usage can't be split
+                continue
+            user["cpu"] += cpu - prev_cpu
+            user["read_bytes"] += max(0, read_bytes - prev_read)
+            user["write_bytes"] += max(0, write_bytes - prev_write)
+
+        usage = []
+        for uid, user in users.items():
+            rec = {"user": user_name(uid), "processes": user["processes"], "rss": user["rss"]}
+            if rates:
+                rec["cpu"] = user["cpu"] / CLK_TCK / interval
+                rec["read_bytes_per_sec"] = user["read_bytes"] / interval
+                rec["write_bytes_per_sec"] = user["write_bytes"] / interval
+            usage.append(rec)
+        usage.sort(key=lambda u: (u.get("cpu", 0), u["rss"]), reverse=True)
+        _logger.debug("%d processes of %d users over %.1fs",
+                      len(self.procs), len(usage), interval)
+        return usage
+
+    def save(self):
+        """persist the current sample, it becomes the previous one"""
+        self.store.save({"uptime": self.uptime, "procs": self.procs})
+        self.uptime_prev = self.uptime
+        self.procs_prev = self.procs
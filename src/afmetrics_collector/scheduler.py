@@ -0,0 +1,95 @@
+"""
+Run collectors periodically inside one long lived process
+
+Each task has its own interval and runs on a thread pool so a slow collector
+does not delay the others. Start times are spread with a random jitter so that
+collectors (and nodes) don't all fire at the same second, and a task that takes
+longer than its period is reported and skipped instead of piling up.
+"""
+
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+_logger = logging.getLogger(__name__)
+
+
+class Task:
+    """Task class holds one periodic collector"""
+    def __init__(self, name, func, interval, jitter=0):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = min(jitter, interval / 2)
+        self.next_run = time.monotonic() + random.uniform(0, self.jitter)
+        self.future = None
+        self.runs = 0
+        self.overruns = 0
+        self.last_duration = None
+
+    def run(self):
+        start = time.monotonic()
+        try:
+            self.func()
+        except Exception as error:
+            _logger.exception("collector %s failed: %s", self.name, error)
+        self.runs += 1
+        self.last_duration = time.monotonic() - start
+        if self.last_duration > self.interval:
+            _logger.warning("collector %s overran its %ss period: took %.1fs",
+                            self.name, self.interval, self.last_duration)
+        else:
+            _logger.debug("collector %s took %.3fs", self.name, self.last_duration)
+
+    def running(self):
+        return self.future is not None and not self.future.done()
+
+    def reschedule(self, now):
+        self.next_run += self.interval + random.uniform(-self.jitter, self.jitter) / 2
+        if self.next_run < now:
+            # we fell behind, don't try to catch up on missed ticks
+            self.next_run = now + random.uniform(0, self.jitter)
+
+
+class Scheduler:
+    """Scheduler class runs tasks at their own intervals until stopped"""
+    def __init__(self, jitter=0, max_workers=None):
+        self.jitter = jitter
+        self.max_workers = max_workers
+        self.tasks = []
+        self.stopped = threading.Event()
+
+    def add(self, name, func, interval):
+        self.tasks.append(Task(name, func, interval, self.jitter))
+
+    def stop(self, *args):
+        self.stopped.set()
+
+    def run_forever(self):
+        if not self.tasks:
+            _logger.warning("nothing to schedule")
+            return
+        _logger.info("scheduling collectors: %s",
+                     ", ".join("{}/{}s".format(t.name, t.interval) for t in self.tasks))
+        executor = ThreadPoolExecutor(max_workers=self.max_workers or len(self.tasks),
+                                      thread_name_prefix="collector")
+        while not self.stopped.is_set():
+            now = time.monotonic()
+            for task in self.tasks:
+                if task.next_run > now:
+                    continue
+                if task.running():
+                    task.overruns += 1
+                    _logger.warning("collector %s still running after its %ss period, "
+                                    "skipping this run (%d overruns)",
+                                    task.name, task.interval, task.overruns)
+                else:
+                    task.future = executor.submit(task.run)
+                task.reschedule(now)
+            delay = min(t.next_run for t in self.tasks) - time.monotonic()
+            if delay > 0:
+                self.stopped.wait(delay)
+        _logger.info("waiting for running collectors to finish")
+        executor.shutdown(wait=True)
@@ -0,0 +1,231 @@
+"""
+Ship collected documents to the logstash endpoint in batches
+
+Documents from all collectors are accumulated and posted as a json array (or
+newline delimited json) over a single keep-alive requests.Session, instead of
+one https round trip per document.
+
+With a :class:`afmetrics_collector.spool.Spool`, batches are written to disk
+first and posted from there, oldest first, by a sender that backs off
+exponentially while logstash is failing; collection never waits for logstash.
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+_logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {"json": "application/json",
+                 "ndjson": "application/x-ndjson"}
+
+
+class Shipper:
+    """Shipper class accumulates documents and posts them in batches"""
+    def __init__(self, url, batch_size=500, max_bytes=5*1024*1024, fmt="json",
+                 debug_local=False, pool_size=4, timeout=60, spool=None, max_backoff=300):
+        if fmt not in CONTENT_TYPES:
+            raise ValueError("unknown batch format: {}".format(fmt))
+        self.url = url
+        self.batch_size = max(1, batch_size)
+        self.max_bytes = max_bytes
+        self.fmt = fmt
+        self.debug_local = debug_local
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Content-Type": CONTENT_TYPES[fmt]})
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_bytes = 0
+        self.stats = {"batches": 0, "documents": 0, "bytes": 0,
+                      "errors": 0, "latency_total": 0.0, "latency_max": 0.0,
+                      "drained": 0, "drain_seconds": 0.0, "dropped": 0}
+        self.closed = False
+        self.spool = spool
+        self.max_backoff = max_backoff
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.sender = None
+
+    def add(self, doc, debug_file="debug.json"):
+        """queue one document, posting a batch once it is full
+
+        Args:
+          doc (dict): the document to send
+          debug_file (str): local file the document is appended to in debug mode
+        """
+        if self.debug_local:
+            # For local debugging
+            json_object = json.dumps(doc, indent=4)
+            with self.lock, open(debug_file, "a") as outfile:
+                outfile.write(json_object)
+            return
+
+        if self.closed:
+            # a collector that was abandoned after its timeout
+            with self.lock:
+                self.stats["dropped"] += 1
+            _logger.warning("shipper closed, dropping %s document", doc.get("kind"))
+            return
+
+        _logger.debug("queue for logstash: %s", doc)
+        encoded = json.dumps(doc, separators=(",", ":")).encode("utf-8")
+        batch = None
+        with self.lock:
+            # +1 for the separator between documents
+            if self.pending and self.pending_bytes + len(encoded) + 1 > self.max_bytes:
+                batch = self._take()
+            self.pending.append(encoded)
+            self.pending_bytes += len(encoded) + 1
+            if batch is None and len(self.pending) >= self.batch_size:
+                batch = self._take()
+        if batch:
+            self._ship(batch)
+
+    def extend(self, docs, debug_file="debug.json"):
+        for doc in docs:
+            self.add(doc, debug_file)
+
+    def flush(self):
+        """post whatever is still pending"""
+        with self.lock:
+            batch = self._take()
+        if batch:
+            self._ship(batch)
+
+    def start_sender(self):
+        """post spooled batches from a background thread (daemon mode)"""
+        self.sender = threading.Thread(target=self._send_forever, name="sender", daemon=True)
+        self.sender.start()
+
+    def close(self):
+        self.flush()
+        self.closed = True
+        if self.spool is not None:
+            if self.sender is not None:
+                self.stopped.set()
+                self.wake.set()
+                self.sender.join(self.timeout)
+            if self.sender is None or not self.sender.is_alive():
+                # one shot runs send their batches now, what fails waits for the next run
+                self.drain()
+            _logger.info("spool: %s", self.metrics())
+            self.spool.close()
+        self.session.close()
+        if self.stats["batches"]:
+            _logger.info("shipped %d documents (%d bytes) in %d batches, "
+                         "avg latency %.3fs, max latency %.3fs, %d errors",
+                         self.stats["documents"], self.stats["bytes"],
+                         self.stats["batches"],
+                         self.stats["latency_total"] / self.stats["batches"],
+                         self.stats["latency_max"], self.stats["errors"])
+
+    def metrics(self):
+        """backlog and drain rate of the spool"""
+        backlog_bytes, backlog_segments = self.spool.backlog()
+        rate = self.stats["drained"] / self.stats["drain_seconds"] \
+            if self.stats["drain_seconds"] else 0.0
+        return dict(self.spool.stats, backlog_bytes=backlog_bytes,
+                    backlog_segments=backlog_segments, drain_rate=round(rate, 1))
+
+    def _ship(self, batch):
+        if self.spool is None:
+            self._post(batch)
+            return
+        try:
+            # compact json has no newline, one per document in the record
+            self.spool.append(b"\n".join(batch))
+        except OSError as error:
+            _logger.error("cannot spool %d documents, posting them now: %s", len(batch), error)
+            self._post(batch)
+            return
+        self.wake.set()
+
+    def drain(self, stop=None):
+        """post spooled batches oldest first until the spool is empty or a post fails
+
+        Returns:
+          empty: True if everything was sent
+        """
+        start = time.monotonic()
+        drained = 0
+        try:
+            while stop is None or not stop.is_set():
+                payload = self.spool.peek()
+                if payload is None:
+                    return True
+                batch = payload.split(b"\n")
+                status = self._post(batch)
+                if status is None or status >= 500 or status == 429:
+                    # logstash is down or overloaded, retry later
+                    return False
+                if status >= 300:
+                    _logger.error("logstash rejected %d documents with status_code:%s, "
+                                  "dropping them", len(batch), status)
+                else:
+                    drained += len(batch)
+                self.spool.commit()
+            return False
+        finally:
+            with self.lock:
+                self.stats["drained"] += drained
+                self.stats["drain_seconds"] += time.monotonic() - start
+
+    def _send_forever(self):
+        backoff = 1
+        while not self.stopped.is_set():
+            self.wake.clear()
+            if self.drain(self.stopped):
+                backoff = 1
+                self.wake.wait()
+                continue
+            if self.stopped.is_set():
+                break
+            delay = random.uniform(backoff / 2, backoff)
+            _logger.warning("sending spooled batches failed, retrying in %.0fs; %s",
+                            delay, self.metrics())
+            self.stopped.wait(delay)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def _take(self):
+        batch = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+        return batch
+
+    def encode(self, batch):
+        if self.fmt == "ndjson":
+            return b"\n".join(batch) + b"\n"
+        return b"[" + b",".join(batch) + b"]"
+
+    def _post(self, batch):
+        body = self.encode(batch)
+        start = time.monotonic()
+        try:
+            resp = self.session.post(self.url, data=body, timeout=self.timeout)
+            status = resp.status_code
+        except requests.RequestException as error:
+            _logger.error("post of %d documents failed: %s", len(batch), error)
+            status = None
+        latency = time.monotonic() - start
+
+        with self.lock:
+            self.stats["batches"] += 1
+            self.stats["latency_total"] += latency
+            self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+            if status is None or status >= 300:
+                self.stats["errors"] += 1
+            else:
+                self.stats["documents"] += len(batch)
+                self.stats["bytes"] += len(body)
+        _logger.info("posted batch of %d documents (%d bytes) in %.3fs, status_code:%s",
+                     len(batch), len(body), latency, status)
+        return status
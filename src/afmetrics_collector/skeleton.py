@@ -16,27 +16,27 @@ References:
 """
 
 import argparse
+import functools
 import logging
+import signal
 import sys
 import socket
-import requests
-
-# needed for debug
-import json
-
-# needed for user obfuscation
-import hashlib
-
-# needed for group filtering
-import grp
-import pwd
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from afmetrics_collector import __version__
 
-from afmetrics_collector.jupyter import get_jupyter_users
+from afmetrics_collector.jupyter import get_jupyter_users, get_jupyter_usage, PodCache
 from afmetrics_collector.ssh import get_ssh_users, get_ssh_history
 from afmetrics_collector.condor import get_condor_history, get_condor_jobs, get_condor_queue_summery
-from afmetrics_collector.host import get_host_metrics
+from afmetrics_collector.condor import get_schedd, BACKENDS, HistoryMark, JobTracker, UserRollup
+from afmetrics_collector.host import get_host_metrics, Xdisks, XNode
+from afmetrics_collector.procs import UserUsage
+from afmetrics_collector.shipper import Shipper
+from afmetrics_collector.spool import Spool
+from afmetrics_collector.users import GroupIndex, Obfuscator
+from afmetrics_collector.scheduler import Scheduler
 
 __author__ = "Fengping Hu"
 __copyright__ = "Fengping Hu"
@@ -44,6 +44,9 @@ __license__ = "MIT"
 
 _logger = logging.getLogger(__name__)
 
+COLLECTORS = ["jupyter", "ssh", "host", "usage", "condor-queue", "condor-jobs",
+              "condor-history"]
+
 
 # ---- CLI ----
 # The functions defined in this section are wrappers around the main Python
@@ -75,6 +78,21 @@ def parse_args(args):
         help="collect ssh metrics",
         default=False
     )
+    parser.add_argument(
+        "--nic-include",
+        dest="nic_include",
+        action='append',
+        help="network interfaces to report per interface, shell pattern (default: all) "
+             "e.g. --nic-include 'eth*' --nic-include 'bond*'",
+        default=[],
+    )
+    parser.add_argument(
+        "--nic-exclude",
+        dest="nic_exclude",
+        action='append',
+        help="network interfaces not to report per interface, shell pattern (default: lo)",
+        default=[],
+    )
     parser.add_argument(
         "-s",
         "--ssh",
@@ -88,9 +106,30 @@ def parse_args(args):
         "--ssh-history",
         action="store_true",
         dest="ssh_history",
-        help="collect ssh metrics from last 5 minutes (note: requires newer version of 'last' with -s option)",
+        help="also count ssh users logged in during the last 5 minutes (from /var/log/wtmp)",
         default=False
     )
+    parser.add_argument(
+        "--usage",
+        action="store_true",
+        dest="usage",
+        help="collect cpu, memory and io usage of the top users of this node",
+        default=False
+    )
+    parser.add_argument(
+        "--usage-top",
+        dest="usage_top",
+        help="number of users reported by --usage, busiest first",
+        default=10,
+        type=int,
+    )
+    parser.add_argument(
+        "--usage-min-uid",
+        dest="usage_min_uid",
+        help="processes of users with a lower uid (system accounts) are not counted by --usage",
+        default=1000,
+        type=int,
+    )
     parser.add_argument(
         "-j",
         "--jupyter",
@@ -107,6 +146,23 @@ def parse_args(args):
         help="collect batch(condor) metrics",
         default=False
     )
+    parser.add_argument(
+        "--jupyter-usage",
+        action="store_true",
+        dest="jupyter_usage",
+        help="also ship a jupyter-usage document per user and hub with the cpu and memory "
+             "usage, requests and limits of their pods (requires metrics-server)",
+        default=False
+    )
+    parser.add_argument(
+        "--hub",
+        dest="hub",
+        action='append',
+        help="jupyter hub to watch, as kind:namespace:label[:timeout] (default: jupyter-ml "
+             "from --namespace/--label and jupyter-coffea:coffea-casa:jhub_user) "
+             "e.g. --hub jupyter-ml:af-jupyter:owner --hub jupyter-gpu:gpu-jupyter:owner:30",
+        default=[],
+    )
     parser.add_argument(
         "-n",
         "--namespace",
@@ -203,6 +259,13 @@ def parse_args(args):
         default="",
         type=str,
     )
+    parser.add_argument(
+        "--group-ttl",
+        dest="group_ttl",
+        help="seconds the group membership index is kept in daemon mode",
+        default=600,
+        type=float,
+    )
     parser.add_argument(
         "-q",
         "--queue",
@@ -212,6 +275,150 @@ def parse_args(args):
         default=[],
         #type=str,
     )
+    parser.add_argument(
+        "--per-queue-query",
+        action="store_true",
+        dest="per_queue_query",
+        help="run condor_q for every queue instead of one query evaluating all queue constraints",
+        default=False,
+    )
+    parser.add_argument(
+        "--condor-backend",
+        dest="condor_backend",
+        help="query condor through the htcondor python bindings or condor_q/condor_history "
+             "(auto: bindings if installed)",
+        choices=BACKENDS,
+        default="auto",
+    )
+    parser.add_argument(
+        "--incremental-history",
+        action="store_true",
+        dest="incremental_history",
+        help="report only jobs finished since the last run, remembered in /run/afmetrics_condor.json",
+        default=False,
+    )
+    parser.add_argument(
+        "--history-lookback",
+        dest="history_lookback",
+        help="maximum seconds of condor history scanned by an incremental run",
+        default=86400,
+        type=int,
+    )
+    parser.add_argument(
+        "--condor-jobs-mode",
+        dest="condor_jobs_mode",
+        help="ship running condor jobs one document per job (jobs), "
+             "one condoruser document per owner (users) or both",
+        choices=["jobs", "users", "both"],
+        default="jobs",
+    )
+    parser.add_argument(
+        "--job-changes",
+        action="store_true",
+        dest="job_changes",
+        help="report only new jobs, state changes and heartbeats of running condor jobs",
+        default=False,
+    )
+    parser.add_argument(
+        "--job-heartbeat",
+        dest="job_heartbeat",
+        help="seconds after which an unchanged job is reported again with --job-changes",
+        default=3600,
+        type=int,
+    )
+    parser.add_argument(
+        "--job-resync",
+        dest="job_resync",
+        help="seconds between two runs reporting all jobs with --job-changes",
+        default=86400,
+        type=int,
+    )
+    parser.add_argument(
+        "--batch-size",
+        dest="batch_size",
+        help="maximum number of documents posted to logstash in one request",
+        default=500,
+        type=int,
+    )
+    parser.add_argument(
+        "--batch-bytes",
+        dest="batch_bytes",
+        help="maximum size in bytes of one request posted to logstash",
+        default=5*1024*1024,
+        type=int,
+    )
+    parser.add_argument(
+        "--batch-format",
+        dest="batch_format",
+        help="encoding of a batch: a json array or newline delimited json",
+        choices=["json", "ndjson"],
+        default="json",
+    )
+    parser.add_argument(
+        "--spool",
+        dest="spool",
+        help="directory where batches are kept until logstash accepted them "
+             "e.g. --spool /var/spool/afmetrics (default: post directly, no retries)",
+        default=None,
+    )
+    parser.add_argument(
+        "--spool-max-bytes",
+        dest="spool_max_bytes",
+        help="disk space of the spool; past it the oldest batches are dropped",
+        default=256*1024*1024,
+        type=int,
+    )
+    parser.add_argument(
+        "--max-backoff",
+        dest="max_backoff",
+        help="longest wait in seconds between attempts to send spooled batches in daemon mode",
+        default=300,
+        type=float,
+    )
+    parser.add_argument(
+        "-D",
+        "--daemon",
+        action="store_true",
+        dest="daemon",
+        help="keep running and collect metrics periodically instead of once",
+        default=False,
+    )
+    parser.add_argument(
+        "--default-interval",
+        dest="default_interval",
+        help="seconds between two runs of a collector in daemon mode",
+        default=300,
+        type=float,
+    )
+    parser.add_argument(
+        "--interval",
+        dest="interval",
+        action='append',
+        help="per collector interval in daemon mode (usage --interval \"collector=seconds\") "
+             "collectors: " + ", ".join(COLLECTORS),
+        default=[],
+    )
+    parser.add_argument(
+        "--jitter",
+        dest="jitter",
+        help="maximum random delay in seconds added to collector start times in daemon mode",
+        default=10,
+        type=float,
+    )
+    parser.add_argument(
+        "--default-timeout",
+        dest="default_timeout",
+        help="seconds a collector may run before it is abandoned",
+        default=240,
+        type=float,
+    )
+    parser.add_argument(
+        "--timeout",
+        dest="timeout",
+        action='append',
+        help="per collector timeout (usage --timeout \"collector=seconds\")",
+        default=[],
+    )
     return parser.parse_args(args)
 
 
@@ -227,255 +434,406 @@ def setup_logging(loglevel):
     )
 
 
-def main(args):
-    """Wrapper allowing :func:`fib` to be called with string arguments in a CLI fashion
-
-    Instead of returning the value from :func:`fib`, it prints the result to the
-    ``stdout`` in a nicely formatted message.
+def obfuscate_host(domain):
+    """atlas host obfuscation: keep the digits of the hostname and append the domain"""
+    if domain != "":
+        return ''.join(['atlas',''.join([n for n in socket.gethostname() if n.isdigit()]),".",domain])
+    return socket.gethostname()
+
+
+def per_collector(values, default):
+    """parse a list of "collector=seconds" options into a dict covering all collectors"""
+    settings = dict.fromkeys(COLLECTORS, default)
+    for value in values:
+        name, _, seconds = value.partition("=")
+        if name not in settings:
+            raise ValueError("unknown collector: {}".format(name))
+        settings[name] = float(seconds)
+    return settings
+
+
+def parse_hubs(values, namespace, label, timeout):
+    """parse a list of "kind:namespace:label[:timeout]" options into hub tuples"""
+    if not values:
+        return [("jupyter-ml", namespace, label, timeout),
+                ("jupyter-coffea", "coffea-casa", "jhub_user", timeout)]
+    hubs = []
+    for value in values:
+        fields = value.split(":")
+        if len(fields) not in (3, 4) or not all(fields[:3]):
+            raise ValueError("hub is not kind:namespace:label[:timeout]: {}".format(value))
+        hub_timeout = timeout
+        if len(fields) == 4:
+            try:
+                hub_timeout = float(fields[3])
+            except ValueError:
+                raise ValueError("hub timeout is not a number of seconds: {}".format(value)) \
+                    from None
+        hubs.append((fields[0], fields[1], fields[2], hub_timeout))
+    return hubs
+
+
+def run_concurrently(collectors, names):
+    """run the collectors once on threads, waiting at most each collector's timeout
+
+    A collector that times out is reported and abandoned, the others are not delayed by it.
+    Collectors run on daemon threads, so an abandoned one doesn't keep the process alive.
 
-    Args:
-      args (List[str]): command line parameters as list of strings
-          (for example  ``["--verbose", "42"]``).
+    Returns:
+      abandoned: names of the collectors that timed out
     """
-    args = parse_args(args)
-    url = args.url
-    token = args.token
-    cluster = args.cluster
-    setup_logging(args.loglevel)
-    if args.jupyter:
-        _logger.info("collecting jupyter-ml metrics")
-        users=get_jupyter_users(args.ns, args.label)
-        _logger.info("af jupyter-ml users: %s", users)
-
-        if args.group != "":
-            # group filter
-            for i, x in enumerate(users[:]):
-                groups = [g.gr_name for g in grp.getgrall() if x in g.gr_mem]
-                gid = pwd.getpwnam(x).pw_gid
-                groups.append(grp.getgrgid(gid).gr_name)
-                if args.group not in groups:
-                    users.remove(x)
-
-        if args.obf_users:
-            # jupyter user hash
-            for i, x in enumerate(users):
-                users[i] = hashlib.sha256((args.salt+x).encode('utf-8')).hexdigest()[:8]
-            
-        myobj = {'token': token,
-                 'kind': 'jupyter-ml',
-                 'cluster': cluster,
-                 'jupyter_user_count': len(users),
-                 'users': users}
-        
-        if args.debug_local:
-            # For local debugging
-            json_object = json.dumps(myobj, indent=4)
-            with open("jupyter-debug.json", "a") as outfile:
-                outfile.write(json_object)
-        else: # post to logstash
-            _logger.debug("post to logstash: %s", myobj)
-            resp = requests.post(url, json=myobj)
-            _logger.debug("post status_code:%d",resp.status_code)
-
-        _logger.info("collecting jupyter-coffea metrics")
-        users=get_jupyter_users("coffea-casa", "jhub_user")
-        _logger.info("af jupyter-coffea users: %s", users)
-
+    def target(name):
+        try:
+            collectors.run(name)
+        except Exception as error:
+            failed.add(name)
+            _logger.exception("collector %s failed: %s", name, error)
+
+    failed = set()
+    threads = {name: threading.Thread(target=target, args=(name,), daemon=True,
+                                      name="collector-" + name) for name in names}
+    start = time.monotonic()
+    for thread in threads.values():
+        thread.start()
+    abandoned = []
+    for name in sorted(names, key=lambda n: collectors.timeouts[n]):
+        remaining = start + collectors.timeouts[name] - time.monotonic()
+        threads[name].join(max(0, remaining))
+        if threads[name].is_alive():
+            _logger.error("collector %s timed out after %ss", name, collectors.timeouts[name])
+            abandoned.append(name)
+        elif name not in failed:
+            _logger.info("collector %s finished", name)
+    return abandoned
+
+
+class Collectors:
+    """Collectors class runs each collector and keeps its state between runs"""
+    def __init__(self, args, shipper):
+        self.args = args
+        self.shipper = shipper
+        self.xd = None
+        self.no = None
+        self.user_usage = None
+        self.pod_caches = {}
+        self.history_window = 360
+        self.timeouts = per_collector(args.timeout, args.default_timeout)
+        self.hubs = parse_hubs(args.hub, args.ns, args.label, self.timeouts["jupyter"])
+        self.schedds = {}
+        self.history_mark = None
+        self.job_tracker = None
+        # one shot runs build the group index once, daemons refresh it
+        self.groups = GroupIndex(ttl=args.group_ttl if args.daemon else None)
+        self.obfuscate = Obfuscator(args.salt)
+
+    def enabled(self):
+        """names of the collectors selected on the command line"""
+        args = self.args
+        names = []
+        if args.jupyter:
+            names.append("jupyter")
+        if args.ssh:
+            names.append("ssh")
+        if args.host:
+            names.append("host")
+        if args.usage:
+            names.append("usage")
+        if args.batch:
+            names.extend(["condor-queue", "condor-jobs", "condor-history"])
+        return names
+
+    def run(self, name):
+        getattr(self, name.replace("-", "_"))()
+        if self.args.group != "":
+            _logger.debug("group index: %s", self.groups.stats())
+        if self.args.obf_users:
+            _logger.debug("user hashes: %s", self.obfuscate.stats())
+        if self.args.daemon:
+            # one shot runs flush everything at the end
+            self.shipper.flush()
+            if self.shipper.spool is not None:
+                _logger.debug("spool: %s", self.shipper.metrics())
+
+    def schedd(self, name):
+        """the schedd used by a condor collector, kept between runs"""
+        if name not in self.schedds:
+            self.schedds[name] = get_schedd(self.args.condor_backend, timeout=self.timeouts[name])
+        return self.schedds[name]
+
+    def pod_cache(self, namespace, label, timeout=None):
+        """the watched pods of a jupyter hub, kept between runs"""
+        if (namespace, label) not in self.pod_caches:
+            self.pod_caches[(namespace, label)] = PodCache(
+                namespace, label, timeout=timeout).start()
+        return self.pod_caches[(namespace, label)]
+
+    def _users(self, users):
+        args = self.args
         if args.group != "":
             # group filter
-            for i, x in enumerate(users[:]):
-                groups = [g.gr_name for g in grp.getgrall() if x in g.gr_mem]
-                gid = pwd.getpwnam(x).pw_gid
-                groups.append(grp.getgrgid(gid).gr_name)
-                if args.group not in groups:
-                    users.remove(x)
-
+            users = [x for x in users if self.groups.is_member(x, args.group)]
         if args.obf_users:
-            # jupyter-coffea user hash
-            for i, x in enumerate(users):
-                users[i] = hashlib.sha256((args.salt+x).encode('utf-8')).hexdigest()[:8]
-
-        myobj = {'token': token,
-                 'kind': 'jupyter-coffea',
-                 'cluster': cluster,
-                 'jupyter_user_count': len(users),
-                 'users': users}
-        if args.debug_local:
-            # For local debugging
-            json_object = json.dumps(myobj, indent=4)
-            with open("jupyter-debug.json", "a") as outfile:
-                outfile.write(json_object)
-        else: # post to logstash
-            _logger.debug("post to logstash: %s", myobj)
-            resp = requests.post(url, json=myobj)
-            _logger.debug("post status_code:%d",resp.status_code)
-
-    if args.ssh:
+            # user hash
+            users = [self.obfuscate(x) for x in users]
+        return users
+
+    def hub_users(self, namespace, label, timeout):
+        if self.args.daemon:
+            return self.pod_cache(namespace, label, timeout).users(timeout=timeout)
+        return get_jupyter_users(namespace, label, timeout=timeout)
+
+    def jupyter(self):
+        args = self.args
+        _logger.info("collecting metrics of %d jupyter hubs", len(self.hubs))
+        # all hubs share one api client and are queried at once
+        with ThreadPoolExecutor(max_workers=2 * len(self.hubs),
+                                thread_name_prefix="hub") as executor:
+            futures = [executor.submit(self.hub_users, namespace, label, timeout)
+                       for kind, namespace, label, timeout in self.hubs]
+            if args.jupyter_usage:
+                usage_futures = [executor.submit(get_jupyter_usage, namespace, label, timeout)
+                                 for kind, namespace, label, timeout in self.hubs]
+        for (kind, namespace, label, timeout), future in zip(self.hubs, futures):
+            try:
+                users = future.result()
+            except Exception as error:
+                # one unreachable hub doesn't hold back the others
+                _logger.error("cannot get %s users: %s", kind, error)
+                continue
+            _logger.info("af %s users: %s", kind, users)
+            users = self._users(users)
+
+            myobj = {'token': args.token,
+                     'kind': kind,
+                     'cluster': args.cluster,
+                     'jupyter_user_count': len(users),
+                     'users': users}
+            self.shipper.add(myobj, "jupyter-debug.json")
+
+        if args.jupyter_usage:
+            for (kind, namespace, label, timeout), future in zip(self.hubs, usage_futures):
+                try:
+                    usage = future.result()
+                except Exception as error:
+                    _logger.error("cannot get %s usage: %s", kind, error)
+                    continue
+                for user in usage:
+                    if args.group != "" and not self.groups.is_member(user["user"], args.group):
+                        continue
+                    if args.obf_users:
+                        user["user"] = self.obfuscate(user["user"])
+                    myobj = {'token': args.token,
+                             'kind': 'jupyter-usage',
+                             'cluster': args.cluster,
+                             'hub': kind}
+                    myobj.update(user)
+                    self.shipper.add(myobj, "jupyter-debug.json")
+
+    def ssh(self):
+        args = self.args
         _logger.info("collecting ssh metrics")
         users=get_ssh_users()
         _logger.info("af ssh users: %s", users)
 
         if args.ssh_history:
-            users.extend(get_ssh_history())
-
-        if args.group != "":
-            # group filter
-            for i, x in enumerate(users[:]):
-                groups = [g.gr_name for g in grp.getgrall() if x in g.gr_mem]
-                gid = pwd.getpwnam(x).pw_gid
-                groups.append(grp.getgrgid(gid).gr_name)
-                if args.group not in groups:
-                    users.remove(x)
-
-        if args.obf_users:
-            # ssh user hash
-            for i, x in enumerate(users):
-                users[i] = hashlib.sha256((args.salt+x).encode('utf-8')).hexdigest()[:8]
-        
-        if args.obf_hosts != "":
-            # atlas ssh host obfuscation
-            ssh_host_name = ''.join(['atlas',''.join([n for n in socket.gethostname() if n.isdigit()]),".",args.obf_hosts])
-        else:
-            ssh_host_name = socket.gethostname()
+            # users still logged in are in the history too
+            users = list(dict.fromkeys(users + get_ssh_history()))
+        users = self._users(users)
 
-        myobj = {'token': token,
+        myobj = {'token': args.token,
                  'kind': 'ssh',
-                 'cluster': cluster,
-                 'login_node': ssh_host_name,
+                 'cluster': args.cluster,
+                 'login_node': obfuscate_host(args.obf_hosts),
                  'ssh_user_count': len(users),
                  'users': users}
+        self.shipper.add(myobj, "ssh.json")
 
-        if args.debug_local:
-            # For local debugging
-            json_object = json.dumps(myobj, indent=4)
-            with open("ssh.json", "a") as outfile:
-                outfile.write(json_object)
-        else: # post to logstash
-            _logger.debug("post to logstash: %s", myobj)
-            resp = requests.post(url, json=myobj)
-            _logger.debug("post status_code:%d",resp.status_code)
-        
-
-    if args.host:
+    def host(self):
+        args = self.args
         _logger.info("collecting host metrics")
-        if args.obf_hosts != "":
-            # atlas host obfuscation
-            login_host_name = ''.join(['atlas',''.join([n for n in socket.gethostname() if n.isdigit()]),".",args.obf_hosts])
-        else:
-            login_host_name = socket.gethostname()
-
-        header = {'token': token,
+        header = {'token': args.token,
                   'kind': 'host',
-                  'cluster': cluster,
-                  'login_node': login_host_name }
-
-        metrics = get_host_metrics(header=header)
+                  'cluster': args.cluster,
+                  'login_node': obfuscate_host(args.obf_hosts)}
+
+        if args.daemon and self.xd is None:
+            # keep disks and counters warm between ticks
+            self.xd = Xdisks(["/home", "/data", "/scratch"])
+            self.no = XNode()
+        metrics = get_host_metrics(header=header, xd=self.xd, no=self.no,
+                                   nics_include=args.nic_include or ["*"],
+                                   nics_exclude=args.nic_exclude or ["lo"])
         _logger.debug("af host metrics: %s", metrics)
-
-        for metric in metrics:
-            if args.debug_local:
-                # For local debugging
-                json_object = json.dumps(metric, indent=4)
-                with open("host.json", "a") as outfile:
-                    outfile.write(json_object)
-            else: # post to logstash
-                _logger.debug("post to logstash: %s", metric)
-                resp = requests.post(url, json=metric)
-                _logger.debug("post status_code:%d",resp.status_code)
-
-    if args.batch:
+        self.shipper.extend(metrics, "host.json")
+
+    def usage(self):
+        args = self.args
+        _logger.info("collecting user usage metrics")
+        if self.user_usage is None:
+            self.user_usage = UserUsage(min_uid=args.usage_min_uid)
+        with self.user_usage.transaction():
+            usage = self.user_usage.sample()
+            self.user_usage.save()
+        if args.group != "":
+            # filter before ranking, the top users are the top members of the group
+            usage = [u for u in usage if self.groups.is_member(u["user"], args.group)]
+        usage = usage[:args.usage_top]
+        if args.obf_users:
+            for u in usage:
+                u["user"] = self.obfuscate(u["user"])
+        _logger.debug("af user usage: %s", usage)
+
+        myobj = {'token': args.token,
+                 'kind': 'user-usage',
+                 'cluster': args.cluster,
+                 'login_node': obfuscate_host(args.obf_hosts),
+                 'users': usage}
+        self.shipper.add(myobj, "usage.json")
+
+    def condor_queue(self):
+        args = self.args
         queues=[]
         if args.queue != "":
             for queue in args.queue:
                 queues.append(dict(zip(["name","constraint"], queue.split(":"))))
-            #    continue
 
         _logger.info("collecting batch metrics - queue summery")
-        queue_status = get_condor_queue_summery(queues=queues)
+        queue_status = get_condor_queue_summery(queues=queues,
+                                                single_query=not args.per_queue_query,
+                                                schedd=self.schedd("condor-queue"))
         _logger.debug("af queue summery: %s", queue_status)
 
         for queue in queue_status:
-            myobj = {'token': token,
+            myobj = {'token': args.token,
                      'kind': 'condorqueue',
-                     'cluster': cluster}
+                     'cluster': args.cluster}
             myobj.update(queue)
+            self.shipper.add(myobj, "condor.json")
 
-            if args.debug_local:
-                # For local debugging
-                json_object = json.dumps(myobj, indent=4)
-                with open("condor.json", "a") as outfile:
-                    outfile.write(json_object)
-            else: # post to logstash
-                _logger.info("post to logstash: %s", myobj)
-                resp = requests.post(url, json=myobj)
-                _logger.debug("post status_code:%d",resp.status_code)
-
-
-        _logger.info("collecting batch metrics - current users")
-        jobs=get_condor_jobs()
-        _logger.debug("af running batch jobs: %s", jobs)
-
+    def _condor_users(self, jobs):
+        """group filter and obfuscate the owners of condor jobs"""
+        args = self.args
         for job in jobs:
-            myobj = {'token': token,
-                     'kind': 'condorjob',
-                     'cluster': cluster}
-            myobj.update(job)
-
-            if args.group != "":
-                # group filter
-                groups = [g.gr_name for g in grp.getgrall() if myobj.get('users') in g.gr_mem]
-                gid = pwd.getpwnam(myobj.get('users')).pw_gid
-                groups.append(grp.getgrgid(gid).gr_name)
-                if args.group not in groups:
-                    continue
-
+            if args.group != "" and not self.groups.is_member(job.get('users'), args.group):
+                continue
             if args.obf_users:
                 # condor user hash
-                myobj.update([('users',hashlib.sha256((args.salt+myobj.get('users')).encode('utf-8')).hexdigest()[:8])])
-
-            if args.debug_local:
-                # For local debugging
-                json_object = json.dumps(myobj, indent=4)
-                with open("condor.json", "a") as outfile:
-                    outfile.write(json_object)
-            else: # post to logstash
-                _logger.debug("post to logstash: %s", myobj)
-                resp = requests.post(url, json=myobj)
-                _logger.debug("post status_code:%d",resp.status_code)
+                job['users'] = self.obfuscate(job.get('users'))
+            yield job
 
-        _logger.info("collecting batch metrics - job history")
-        jobs=get_condor_history(since_insecs=360)
-        _logger.debug("af finished batch jobs: %s", jobs)
+    def _condor_jobs(self, jobs, extra={}):
+        """ship condor jobs as they are read from the schedd, returns how many"""
+        args = self.args
+        count = 0
         for job in jobs:
-            myobj = {'token': token,
+            myobj = {'token': args.token,
                      'kind': 'condorjob',
-                     'cluster': cluster,
-                     'state': 'finished'}
+                     'cluster': args.cluster}
+            myobj.update(extra)
             myobj.update(job)
-            
-            if args.group != "":
-                # group filter
-                groups = [g.gr_name for g in grp.getgrall() if myobj.get('users') in g.gr_mem]
-                gid = pwd.getpwnam(myobj.get('users')).pw_gid
-                groups.append(grp.getgrgid(gid).gr_name)
-                if args.group not in groups:
-                    continue
-            
-            if args.obf_users:
-                # condor user hash
-                myobj.update([('users',hashlib.sha256((args.salt+myobj.get('users')).encode('utf-8')).hexdigest()[:8])])
-            
-            if args.debug_local:
-                # For local debugging
-                json_object = json.dumps(myobj, indent=4)
-                with open("condor.json", "a") as outfile:
-                    outfile.write(json_object)
-            else: # post to logstash
-                _logger.debug("post to logstash: %s", myobj)
-                resp = requests.post(url, json=myobj)
-                _logger.debug("post status_code:%d",resp.status_code)
+            myobj.pop('allocated_cores', None)
+            myobj.pop('allocated_mem', None)
+
+            self.shipper.add(myobj, "condor.json")
+            count += 1
+        return count
+
+    def condor_jobs(self):
+        args = self.args
+        _logger.info("collecting batch metrics - current users")
+        rollup = UserRollup() if args.condor_jobs_mode != "jobs" else None
+        jobs = self._condor_users(get_condor_jobs(schedd=self.schedd("condor-jobs"),
+                                                  resources=rollup is not None))
+        if rollup is not None:
+            jobs = rollup.feed(jobs)
+
+        if args.condor_jobs_mode == "users":
+            for _ in jobs:
+                pass
+        else:
+            if args.job_changes:
+                if self.job_tracker is None:
+                    self.job_tracker = JobTracker(heartbeat=args.job_heartbeat,
+                                                  resync=args.job_resync)
+                with self.job_tracker.transaction():
+                    count = self._condor_jobs(self.job_tracker.select(jobs))
+                    self.job_tracker.save()
+            else:
+                count = self._condor_jobs(jobs)
+            _logger.info("af running batch jobs: %d", count)
+
+        if rollup is not None:
+            count = 0
+            for user in rollup.documents():
+                myobj = {'token': args.token,
+                         'kind': 'condoruser',
+                         'cluster': args.cluster}
+                myobj.update(user)
+                self.shipper.add(myobj, "condor.json")
+                count += 1
+            _logger.info("af batch users: %d", count)
+
+    def condor_history(self):
+        _logger.info("collecting batch metrics - job history")
+        if not self.args.incremental_history:
+            self._condor_history()
+            return
+        if self.history_mark is None:
+            self.history_mark = HistoryMark()
+        with self.history_mark.transaction():
+            self._condor_history()
+            self.history_mark.save()
+
+    def _condor_history(self):
+        jobs=get_condor_history(since_insecs=self.history_window,
+                                schedd=self.schedd("condor-history"),
+                                mark=self.history_mark,
+                                max_lookback=self.args.history_lookback)
+        count = self._condor_jobs(self._condor_users(jobs), {'state': 'finished'})
+        _logger.info("af finished batch jobs: %d", count)
+
+
+def main(args):
+    """Wrapper allowing :func:`fib` to be called with string arguments in a CLI fashion
 
+    Instead of returning the value from :func:`fib`, it prints the result to the
+    ``stdout`` in a nicely formatted message.
 
+    Args:
+      args (List[str]): command line parameters as list of strings
+          (for example  ``["--verbose", "42"]``).
+    """
+    args = parse_args(args)
+    setup_logging(args.loglevel)
+    spool = None
+    if args.spool and not args.debug_local:
+        spool = Spool(args.spool, max_bytes=args.spool_max_bytes)
+    shipper = Shipper(args.url, batch_size=args.batch_size, max_bytes=args.batch_bytes,
+                      fmt=args.batch_format, debug_local=args.debug_local,
+                      spool=spool, max_backoff=args.max_backoff)
+    collectors = Collectors(args, shipper)
+
+    if args.daemon:
+        intervals = per_collector(args.interval, args.default_interval)
+        # overlap the history window a bit so no finished job falls in a gap
+        collectors.history_window = intervals["condor-history"] + 60
+
+        scheduler = Scheduler(jitter=args.jitter)
+        for name in collectors.enabled():
+            scheduler.add(name, functools.partial(collectors.run, name), intervals[name])
+        signal.signal(signal.SIGTERM, scheduler.stop)
+        signal.signal(signal.SIGINT, scheduler.stop)
+        if spool is not None:
+            shipper.start_sender()
+        scheduler.run_forever()
+        abandoned = []
+    else:
+        abandoned = run_concurrently(collectors, collectors.enabled())
+
+    shipper.close()
+    if abandoned:
+        _logger.warning("exiting without collectors %s, whatever they collect from now on "
+                        "is dropped", ", ".join(abandoned))
 
     _logger.info("Script ends here")
 
@@ -0,0 +1,182 @@
+"""
+Keep batches on disk until logstash has accepted them
+
+Batches are appended to segment files (one record per batch: length, crc32,
+payload) and read back oldest first by the sender; a segment is deleted once
+everything in it was sent. The position of the sender is persisted, so a
+restarted collector resumes where it stopped instead of sending again.
+
+Disk usage is bounded: when the spool grows past max_bytes the oldest
+segments are dropped, unsent or not. A record whose checksum doesn't match
+(the collector died while appending it) ends its segment.
+"""
+
+import logging
+import os
+import struct
+import threading
+import zlib
+
+from afmetrics_collector.state import StateStore
+
+_logger = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct("<II")  # payload length, crc32 of the payload
+SEGMENT_SUFFIX = ".seg"
+
+
+class Spool:
+    """Spool class is an append only, checksummed queue of batches in segment files"""
+    def __init__(self, directory, max_bytes=256*1024*1024, segment_bytes=4*1024*1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.cursor_store = StateStore(os.path.join(directory, "cursor.json"))
+        self.sizes = {}
+        for name in os.listdir(directory):
+            if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit():
+                self.sizes[int(name[:-len(SEGMENT_SUFFIX)])] = \
+                    os.path.getsize(os.path.join(directory, name))
+        cursor = self.cursor_store.load(default={})
+        self.read_segment = cursor.get("segment", 0)
+        self.read_offset = cursor.get("offset", 0)
+        for segment in [s for s in self.sizes if s < self.read_segment]:
+            self._delete(segment)
+        if self.sizes and self.read_segment not in self.sizes:
+            # the segment being read is gone, start at the oldest left
+            self.read_segment, self.read_offset = min(self.sizes), 0
+        # never append after what a crash may have left half written
+        self.write_segment = max(self.sizes, default=self.read_segment - 1) + 1
+        self.writer = None
+        self.peeked = None
+        self.stats = {"appended": 0, "sent": 0, "evicted_segments": 0,
+                      "evicted_bytes": 0, "corrupt": 0}
+
+    def _path(self, segment):
+        return os.path.join(self.directory, "{:012d}{}".format(segment, SEGMENT_SUFFIX))
+
+    def _delete(self, segment):
+        try:
+            os.unlink(self._path(segment))
+        except FileNotFoundError:
+            pass
+        self.sizes.pop(segment, None)
+
+    def size(self):
+        return sum(self.sizes.values())
+
+    def backlog(self):
+        """bytes and segments not sent yet"""
+        with self.lock:
+            return self.size() - self.read_offset, len(self.sizes)
+
+    def append(self, payload):
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self.lock:
+            if self.writer is None or self.sizes[self.write_segment] + len(record) > \
+                    self.segment_bytes and self.sizes[self.write_segment]:
+                self._roll()
+            try:
+                self.writer.write(record)
+                self.writer.flush()
+                os.fsync(self.writer.fileno())
+            except OSError:
+                # disk full: what made it to the file is unknown, start over in a new segment
+                self._abandon_writer()
+                raise
+            self.sizes[self.write_segment] += len(record)
+            self.stats["appended"] += 1
+            self._evict()
+
+    def _roll(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.write_segment += 1
+        self.writer = open(self._path(self.write_segment), "ab")
+        self.sizes[self.write_segment] = 0
+
+    def _abandon_writer(self):
+        """stop appending to the current segment, the next append starts a new one"""
+        try:
+            self.writer.close()
+        except OSError:
+            pass
+        self.writer = None
+        try:
+            self.sizes[self.write_segment] = os.path.getsize(self._path(self.write_segment))
+        except OSError:
+            self.sizes.pop(self.write_segment, None)
+        self.write_segment += 1
+
+    def _evict(self):
+        while self.size() > self.max_bytes and len(self.sizes) > 1:
+            oldest = min(self.sizes)
+            unsent = self.sizes[oldest] - (self.read_offset if oldest == self.read_segment else 0)
+            _logger.warning("spool over %d bytes, dropping %d unsent bytes of segment %d",
+                            self.max_bytes, unsent, oldest)
+            self.stats["evicted_segments"] += 1
+            self.stats["evicted_bytes"] += unsent
+            self._delete(oldest)
+            if oldest == self.read_segment:
+                self.read_segment, self.read_offset = min(self.sizes), 0
+                self.peeked = None
+
+    def peek(self):
+        """the oldest batch not sent yet, or None if the spool is empty"""
+        with self.lock:
+            if self.peeked is None:
+                self.peeked = self._read()
+            return self.peeked[2] if self.peeked else None
+
+    def _read(self):
+        while self.read_segment in self.sizes:
+            if self.read_offset < self.sizes[self.read_segment]:
+                with open(self._path(self.read_segment), "rb") as f:
+                    f.seek(self.read_offset)
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) == RECORD_HEADER.size:
+                        length, crc = RECORD_HEADER.unpack(header)
+                        payload = f.read(length)
+                        if len(payload) == length and zlib.crc32(payload) == crc:
+                            return (self.read_segment,
+                                    self.read_offset + RECORD_HEADER.size + length, payload)
+                _logger.error("corrupt record in spool segment %d at %d, skipping the rest",
+                              self.read_segment, self.read_offset)
+                self.stats["corrupt"] += 1
+                if self.read_segment == self.write_segment and self.writer is not None:
+                    # continue appending to a fresh segment
+                    self._abandon_writer()
+            elif self.read_segment == self.write_segment:
+                # everything written was sent
+                return None
+            # done with this segment
+            self._next_segment()
+        return None
+
+    def _next_segment(self):
+        """delete the segment being read and start reading the next one"""
+        self._delete(self.read_segment)
+        # with nothing left, the next segment is the one appended to next
+        self.read_segment = min(self.sizes, default=self.write_segment)
+        self.read_offset = 0
+
+    def commit(self):
+        """mark the batch returned by peek as sent"""
+        with self.lock:
+            if self.peeked is None:
+                return
+            self.read_segment, self.read_offset, _ = self.peeked
+            self.peeked = None
+            self.stats["sent"] += 1
+            if self.read_segment != self.write_segment and \
+                    self.read_offset >= self.sizes.get(self.read_segment, 0):
+                self._next_segment()
+            self.cursor_store.save({"segment": self.read_segment, "offset": self.read_offset})
+
+    def close(self):
+        with self.lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
@@ -1,34 +1,126 @@
 """
-Allows you to pick a context and then lists all pods in the chosen context. A
-context includes a cluster, a user, and a namespace.
-Please install the pick library before running this example.
+List the users logged in to this node, and those who were recently
+
+Sessions are read directly from the utmp (current logins) and wtmp (login
+history) files instead of running `who` and `last`, whose options differ
+between distributions. Records are the glibc `struct utmp` of 64 bit Linux.
 """
 
-import subprocess
 import logging
-
+import os
+import struct
+import time
+from collections import namedtuple
 
 _logger = logging.getLogger(__name__)
 
+# ut_type, ut_pid, ut_line, ut_id, ut_user, ut_host, e_termination, e_exit,
+# ut_session, tv_sec, tv_usec, ut_addr_v6, padding
+UTMP_RECORD = struct.Struct("hi32s4s32s256shhiii4i20x")
+
+BOOT_TIME = 2
+USER_PROCESS = 7
+DEAD_PROCESS = 8
+
+Session = namedtuple("Session", ["user", "tty", "host", "login_time", "pid"])
+
+
+def _string(field):
+    return field.split(b"\0", 1)[0].decode("utf-8", "replace")
+
+
+def parse_record(record):
+    """(ut_type, Session) of one utmp record"""
+    (ut_type, pid, line, _id, user, host, _term, _exit, _session,
+     tv_sec, _usec, *_addr) = UTMP_RECORD.unpack(record)
+    return ut_type, Session(_string(user), _string(line), _string(host), tv_sec, pid)
+
+
+def read_utmp(file_path="/var/run/utmp"):
+    """yield the sessions of the users logged in now"""
+    with open(file_path, "rb") as f:
+        data = f.read()
+    size = UTMP_RECORD.size
+    for offset in range(0, len(data) - size + 1, size):
+        ut_type, session = parse_record(data[offset:offset + size])
+        if ut_type == USER_PROCESS and session.user:
+            yield session
+
 
-def get_ssh_users():
+def read_wtmp_backwards(file_path="/var/log/wtmp", chunk_records=1024):
+    """yield (ut_type, Session) of the wtmp records, newest first
+
+    The file is read from its end in chunks, so looking at the last minutes
+    of a large wtmp doesn't read all of it.
+    """
+    size = UTMP_RECORD.size
+    with open(file_path, "rb") as f:
+        # ignore a record being appended right now
+        end = os.fstat(f.fileno()).st_size // size * size
+        while end > 0:
+            start = max(0, end - chunk_records * size)
+            f.seek(start)
+            data = f.read(end - start)
+            for offset in range(len(data) - size, -1, -size):
+                yield parse_record(data[offset:offset + size])
+            end = start
+
+
+def read_wtmp_since(since, file_path="/var/log/wtmp", max_session=7 * 86400):
+    """yield the sessions that were open at some point since `since` (epoch seconds)
+
+    These are logins after `since`, and older logins whose logout is after it.
+    Logins are matched to their logout by tty; a session longer than
+    `max_session` seconds that ended in the window is not found.
+    """
+    # ttys logged out in the window, waiting for their login record
+    logged_out = set()
+    for ut_type, session in read_wtmp_backwards(file_path):
+        if session.login_time < since and \
+                (not logged_out or session.login_time < since - max_session):
+            break
+        if ut_type == DEAD_PROCESS:
+            if session.login_time >= since:
+                logged_out.add(session.tty)
+        elif ut_type == USER_PROCESS and session.user:
+            if session.login_time >= since or session.tty in logged_out:
+                yield session
+            logged_out.discard(session.tty)
+        elif ut_type == BOOT_TIME:
+            # sessions before a reboot ended with it
+            if session.login_time < since:
+                break
+
+
+def _unique_users(sessions):
     users = []
+    seen = set()
+    for session in sessions:
+        if session.user not in seen:
+            seen.add(session.user)
+            users.append(session.user)
+    return users
+
+
+def get_ssh_sessions(file_path="/var/run/utmp"):
+    sessions = []
     try:
-        with subprocess.Popen(['who'], stdout=subprocess.PIPE) as process:
-            any(users.append(l.split()[0].decode("utf-8")) for l in process.stdout.readlines()
-                    if l.split()[0].decode("utf-8") not in users)
+        sessions = list(read_utmp(file_path))
     except Exception as error:
         _logger.error(error)
+    return sessions
 
+
+def get_ssh_users(file_path="/var/run/utmp"):
+    users = _unique_users(get_ssh_sessions(file_path))
     _logger.debug("ssh users: %s", users)
     return users
 
-def get_ssh_history():
+
+def get_ssh_history(since_insecs=300, file_path="/var/log/wtmp"):
     users = []
     try:
-        with subprocess.Popen(['/usr/bin/last -w -s -5min | head -n -2'], shell=True, stdout=subprocess.PIPE) as process:
-            any(users.append(l.split()[0].decode("utf-8")) for l in process.stdout.readlines()
-                    if l.split()[0].decode("utf-8") not in users)
+        users = _unique_users(read_wtmp_since(time.time() - since_insecs, file_path))
     except Exception as error:
         _logger.error(error)
 
@@ -0,0 +1,112 @@
+"""
+Persist the previous samples collectors need to compute deltas
+
+State is written to a temporary file in the same directory and renamed over
+the old one, so a run interrupted mid-write leaves the previous state intact
+instead of a truncated file. Overlapping runs (cron) are serialized with an
+flock on a side lock file, since the state file itself is replaced on every
+write. A collector holds that lock through :meth:`Stateful.transaction`
+from loading the previous state to saving the new one, so a second run waits
+instead of computing from the same state and overwriting the first one's.
+Each file carries a schema version; state written by another version is
+ignored rather than misread.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+_logger = logging.getLogger(__name__)
+
+VERSION = 1
+
+
+class StateStore:
+    """StateStore class reads and atomically replaces one json state file"""
+    def __init__(self, path, version=VERSION):
+        self.path = path
+        self.version = version
+        self.lock = threading.RLock()
+        self.lock_file = None
+
+    @contextmanager
+    def locked(self, mode):
+        with self.lock:
+            if self.lock_file is not None:
+                # within a transaction, already held exclusively
+                yield
+                return
+            try:
+                lock_file = open(self.path + ".lock", "a")
+            except OSError as error:
+                # read only /run: still usable, just not serialized between processes
+                _logger.debug("cannot lock %s: %s", self.path, error)
+                yield
+                return
+            try:
+                fcntl.flock(lock_file, mode)
+                self.lock_file = lock_file
+                yield
+            finally:
+                self.lock_file = None
+                lock_file.close()
+
+    def transaction(self):
+        """hold the lock exclusively, across a load and the save that follows it"""
+        return self.locked(fcntl.LOCK_EX)
+
+    def load(self, default=None):
+        """the saved state, or default if there is none usable"""
+        try:
+            with self.locked(fcntl.LOCK_SH):
+                with open(self.path, "r") as f:
+                    data = json.load(f)
+        except FileNotFoundError:
+            return default
+        except (OSError, ValueError) as error:
+            _logger.warning("ignoring unreadable state %s: %s", self.path, error)
+            return default
+        if not isinstance(data, dict) or data.get("version") != self.version:
+            _logger.info("ignoring state %s of another version", self.path)
+            return default
+        return data.get("data", default)
+
+    def save(self, data):
+        """replace the saved state with data, atomically"""
+        jdata = json.dumps({"version": self.version, "data": data})
+        directory = os.path.dirname(self.path) or "."
+        with self.locked(fcntl.LOCK_EX):
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix=".afmetrics", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    f.write(jdata)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+
+
+class Stateful:
+    """Stateful class is the base of the collectors that keep state between ticks
+
+    Subclasses set `store` and implement `restore(data)`, which also sets the
+    defaults when called with {}. The saved state is only read by
+    :meth:`transaction`, once per tick.
+    """
+    store = None
+
+    def restore(self, data):
+        raise NotImplementedError
+
+    @contextmanager
+    def transaction(self):
+        """restore the saved state and keep it locked until the tick saved the new one"""
+        with self.store.transaction():
+            self.restore(self.store.load(default={}))
+            yield self
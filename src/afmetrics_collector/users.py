@@ -0,0 +1,90 @@
+"""
+Group filtering and obfuscation of user names, shared by all collectors
+
+The group database is enumerated once into a user -> groups index instead of
+calling grp.getgrall() for every user (or every condor job), which on
+LDAP/SSSD nodes is a network scan per call. User hashes are memoized so the
+cost scales with distinct users rather than jobs.
+"""
+
+import functools
+import grp
+import hashlib
+import logging
+import pwd
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class GroupIndex:
+    """GroupIndex class maps users to the names of their groups, rebuilt after ttl seconds"""
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.members = None
+        self.built = 0
+        self.primary = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _build(self):
+        start = time.monotonic()
+        members = {}
+        for group in grp.getgrall():
+            for user in group.gr_mem:
+                members.setdefault(user, set()).add(group.gr_name)
+        self.members = members
+        self.primary = {}
+        self.built = time.monotonic()
+        _logger.debug("indexed secondary groups of %d users in %.3fs",
+                      len(members), self.built - start)
+
+    def groups(self, user):
+        """names of the primary and secondary groups of user"""
+        with self.lock:
+            if self.members is None or (self.ttl is not None
+                                        and time.monotonic() - self.built > self.ttl):
+                self._build()
+            if user in self.primary:
+                self.hits += 1
+            else:
+                self.misses += 1
+                try:
+                    gid = pwd.getpwnam(user).pw_gid
+                    self.primary[user] = grp.getgrgid(gid).gr_name
+                except KeyError:
+                    # unknown user or primary group, only secondary groups count
+                    self.primary[user] = None
+            groups = set(self.members.get(user, ()))
+            if self.primary[user] is not None:
+                groups.add(self.primary[user])
+            return groups
+
+    def is_member(self, user, group):
+        return group in self.groups(user)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "users": len(self.primary)}
+
+
+class Obfuscator:
+    """Obfuscator class hashes user names with a salt, remembering recent results"""
+    def __init__(self, salt="", maxsize=4096):
+        # the salt is hashed once, each user continues from a copy
+        self.seeded = hashlib.sha256(salt.encode('utf-8'))
+        self.hash = functools.lru_cache(maxsize=maxsize)(self._hash)
+
+    def _hash(self, user):
+        hasher = self.seeded.copy()
+        hasher.update(user.encode('utf-8'))
+        return hasher.hexdigest()[:8]
+
+    def __call__(self, user):
+        return self.hash(user)
+
+    def stats(self):
+        info = self.hash.cache_info()
+        return {"hits": info.hits, "misses": info.misses, "users": info.currsize}
@@ -8,3 +8,204 @@
 """
 
 # import pytest
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from afmetrics_collector.constraint import Constraint
+
+
+class FakeSchedd:
+    """FakeSchedd class serves job ads from memory like htcondor.Schedd"""
+    def __init__(self, jobs=(), history=()):
+        self.jobs = [{k.lower(): v for k, v in ad.items()} for ad in jobs]
+        self.finished = [{k.lower(): v for k, v in ad.items()} for ad in history]
+        self.queries = []
+        # raise after this many ads, like a condor command that was killed
+        self.fail_after = None
+
+    @staticmethod
+    def _select(ads, constraint, projection, match=-1):
+        constraint = Constraint(constraint)
+        keep = [a.lower() for a in projection]
+        result = []
+        for ad in ads:
+            if match >= 0 and len(result) >= match:
+                break
+            if constraint.matches(ad):
+                result.append({k: v for k, v in ad.items() if not keep or k in keep})
+        return result
+
+    def _stream(self, ads):
+        for i, ad in enumerate(ads):
+            if self.fail_after is not None and i >= self.fail_after:
+                raise RuntimeError("condor command exited with -9")
+            yield ad
+
+    def query(self, constraint="true", projection=[]):
+        self.queries.append(("query", constraint, list(projection)))
+        return self._stream(self._select(self.jobs, constraint, projection))
+
+    def history(self, constraint="true", projection=[], match=-1, since=None):
+        self.queries.append(("history", constraint, list(projection)))
+        return self._stream(self._select(self.finished, constraint, projection, match))
+
+
+@pytest.fixture
+def fake_schedd():
+    return FakeSchedd(
+        jobs=[{"Owner": "alice", "ClusterId": 10, "ProcId": 0, "JobStatus": 2,
+               "RemoteWallClockTime": 120.0, "CpusProvisioned": 4,
+               "MemoryProvisioned": 2048, "queue": "short"},
+              {"Owner": "alice", "ClusterId": 10, "ProcId": 1, "JobStatus": 1,
+               "RemoteWallClockTime": 0.0, "queue": "short"},
+              {"Owner": "bob", "ClusterId": 11, "ProcId": 0, "JobStatus": 5,
+               "RemoteWallClockTime": 30.0},
+              {"Owner": "bob", "ClusterId": 12, "ProcId": 0, "JobStatus": 2,
+               "RemoteWallClockTime": 60.0, "CpusProvisioned": 1,
+               "MemoryProvisioned": 100},
+              {"Owner": "atlas-coffea", "ClusterId": 13, "ProcId": 0, "JobStatus": 2,
+               "RemoteWallClockTime": 60.0, "CpusProvisioned": 8,
+               "MemoryProvisioned": 1000}],
+        history=[{"Owner": "carol", "ClusterId": 5, "ProcId": 0, "JobStatus": 4,
+                  "RemoteWallClockTime": 177.0, "JobFinishedHookDone": 2000000000},
+                 {"Owner": "carol", "ClusterId": 4, "ProcId": 0, "JobStatus": 4,
+                  "RemoteWallClockTime": 10.0, "JobFinishedHookDone": 1000}])
+
+
+def fake_pod(name, owner, label="owner", resource_version="1", phase="Running"):
+    return {"kind": "Pod", "apiVersion": "v1",
+            "metadata": {"name": name, "namespace": "ns", "labels": {label: owner},
+                         "resourceVersion": resource_version},
+            "status": {"phase": phase}}
+
+
+class FakeKube(ThreadingHTTPServer):
+    """FakeKube class serves scripted pod lists and watches like a kubernetes apiserver
+
+    Each list request is answered with the next of `lists` (the last one is
+    repeated), each watch request streams the next of `watches` and ends.
+    Lists honour limit/continue, a status.phase field selector and the
+    metadata only Accept header. `metrics` is served as the metrics.k8s.io
+    pod metrics of any namespace. Requests for the namespaces in `failing`
+    get a 500.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeKubeHandler)
+        self.lists = []
+        self.watches = []
+        self.requests = []
+        self.bytes_sent = 0
+        self.metrics = []
+        self.failing = set()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+
+class FakeKubeHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self.server.requests.append((url.path, query))
+        if any("/namespaces/{}/".format(ns) in url.path for ns in self.server.failing):
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        if url.path.startswith("/apis/metrics.k8s.io/"):
+            self.wfile.write(json.dumps({"kind": "PodMetricsList",
+                                         "apiVersion": "metrics.k8s.io/v1beta1",
+                                         "metadata": {}, "items": self.server.metrics}).encode())
+        elif query.get("watch") == "true":
+            if not self.server.watches:
+                # nothing happens until the watch times out
+                time.sleep(0.1)
+                return
+            for event in self.server.watches.pop(0):
+                self.wfile.write(json.dumps(event).encode() + b"\n")
+        else:
+            items, resource_version = self.server.lists[0]
+            if len(self.server.lists) > 1 and "continue" not in query:
+                self.server.lists.pop(0)
+            kind = "PodList"
+            if "fieldSelector" in query:
+                phase = query["fieldSelector"].partition("status.phase=")[2]
+                items = [i for i in items if i["status"]["phase"] == phase]
+            if "as=PartialObjectMetadataList" in self.headers.get("Accept", ""):
+                kind = "PartialObjectMetadataList"
+                items = [{"kind": "PartialObjectMetadata", "metadata": i["metadata"]}
+                         for i in items]
+            metadata = {"resourceVersion": resource_version}
+            start = int(query.get("continue", 0))
+            end = start + int(query.get("limit", len(items)))
+            if end < len(items):
+                metadata["continue"] = str(end)
+            body = json.dumps({"kind": kind, "apiVersion": "v1", "metadata": metadata,
+                               "items": items[start:end]}).encode()
+            self.server.bytes_sent += len(body)
+            self.wfile.write(body)
+
+
+@pytest.fixture
+def fake_kube():
+    server = FakeKube()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def kube_api(fake_kube):
+    kubernetes = pytest.importorskip("kubernetes")
+    configuration = kubernetes.client.Configuration()
+    configuration.host = fake_kube.url
+    return kubernetes.client.CoreV1Api(kubernetes.client.ApiClient(configuration))
+
+
+class Logstash(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append((self.headers["Content-Type"], body))
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        if status == 200:
+            if self.headers["Content-Type"] == "application/x-ndjson":
+                self.server.received.extend(json.loads(line) for line in body.splitlines())
+            else:
+                self.server.received.extend(json.loads(body))
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+@pytest.fixture
+def logstash():
+    """a logstash http input answering with the queued statuses, then 200"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Logstash)
+    server.statuses = []
+    server.requests = []
+    server.received = []
+    server.url = "http://127.0.0.1:{}".format(server.server_address[1])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,83 @@
+import threading
+
+import pytest
+from conftest import fake_pod
+
+from afmetrics_collector import jupyter, skeleton
+from afmetrics_collector.skeleton import Collectors, parse_args, parse_hubs, run_concurrently
+
+__author__ = "Fengping Hu"
+__copyright__ = "Fengping Hu"
+__license__ = "MIT"
+
+
+class SlowCollectors:
+    """SlowCollectors class stands in for Collectors, "hung" never returns"""
+    timeouts = {"hung": 0.2, "quick": 5, "broken": 5}
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.ran = []
+
+    def run(self, name):
+        if name == "hung":
+            self.release.wait()
+        if name == "broken":
+            raise OSError("no condor_q")
+        self.ran.append(name)
+
+
+def test_run_concurrently():
+    collectors = SlowCollectors()
+    assert run_concurrently(collectors, ["hung", "quick", "broken"]) == ["hung"]
+    assert collectors.ran == ["quick"]
+    # the abandoned collector is on a daemon thread, it doesn't hold the exit
+    hung = [t for t in threading.enumerate() if t.name == "collector-hung"]
+    assert hung and hung[0].daemon
+    collectors.release.set()
+
+
+def test_parse_hubs():
+    assert parse_hubs([], "af-jupyter", "owner", 10) == [
+        ("jupyter-ml", "af-jupyter", "owner", 10),
+        ("jupyter-coffea", "coffea-casa", "jhub_user", 10)]
+    assert parse_hubs(["jupyter-ml:ns:owner", "jupyter-gpu:gpu:owner:30"], "", "", 10) == [
+        ("jupyter-ml", "ns", "owner", 10), ("jupyter-gpu", "gpu", "owner", 30.0)]
+    for value in ["jupyter-ml:ns", "jupyter-ml::owner", "a:b:c:1:2"]:
+        with pytest.raises(ValueError, match="kind:namespace:label"):
+            parse_hubs([value], "", "", 10)
+    for value in ["jupyter-ml:ns:owner:", "jupyter-ml:ns:owner:soon"]:
+        with pytest.raises(ValueError, match="hub timeout"):
+            parse_hubs([value], "", "", 10)
+
+
+class ListShipper:
+    """ListShipper class keeps the documents instead of posting them"""
+    def __init__(self):
+        self.docs = []
+
+    def add(self, doc, debug_file=None):
+        self.docs.append(doc)
+
+
+def test_failing_hub(fake_kube, kube_api, monkeypatch):
+    monkeypatch.setattr(jupyter, "_api", kube_api)
+    fake_kube.lists = [([fake_pod("jupyter-alice", "alice"), fake_pod("jupyter-bob", "bob")],
+                        "10")]
+    fake_kube.failing = {"broken"}
+    args = parse_args(["--jupyter", "--hub", "jupyter-ml:ns:owner",
+                       "--hub", "jupyter-broken:broken:owner:5"])
+    shipper = ListShipper()
+    Collectors(args, shipper).jupyter()
+    # the unreachable hub is logged, the other one still reported
+    assert [(d["kind"], d["users"]) for d in shipper.docs] == \
+        [("jupyter-ml", ["alice", "bob"])]
+
+
+def test_ssh_history(monkeypatch):
+    monkeypatch.setattr(skeleton, "get_ssh_users", lambda: ["alice", "bob"])
+    monkeypatch.setattr(skeleton, "get_ssh_history", lambda: ["bob", "carol", "alice"])
+    shipper = ListShipper()
+    Collectors(parse_args(["--ssh", "--ssh-history"]), shipper).ssh()
+    assert shipper.docs[0]["users"] == ["alice", "bob", "carol"]
+    assert shipper.docs[0]["ssh_user_count"] == 3
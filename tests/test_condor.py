@@ -0,0 +1,212 @@
+import io
+import time
+
+import pytest
+from conftest import FakeSchedd
+
+from afmetrics_collector.condor import (BindingsSchedd, bounded, get_condor_history,
+                                        get_condor_jobs, get_condor_queue_summery,
+                                        HistoryMark,
+                                        JobTracker, UserRollup, iter_json_array)
+
+__author__ = "Fengping Hu"
+__copyright__ = "Fengping Hu"
+__license__ = "MIT"
+
+QUEUES = [{"name": "all", "constraint": ""},
+          {"name": "short", "constraint": 'queue == "short"'}]
+
+
+def test_queue_summery(fake_schedd):
+    summery = get_condor_queue_summery(QUEUES, schedd=fake_schedd)
+    assert len(fake_schedd.queries) == 1
+    assert "queue" in fake_schedd.queries[0][2]
+    assert summery == [
+        {"queue": "all", "idle": 1, "running": 3, "held": 1,
+         "allocated_cores": 13, "allocated_mem": 3148},
+        {"queue": "short", "idle": 1, "running": 1, "held": 0,
+         "allocated_cores": 4, "allocated_mem": 2048}]
+
+
+def test_queue_summery_per_queue(fake_schedd):
+    single = get_condor_queue_summery(QUEUES, schedd=fake_schedd)
+    per_queue = get_condor_queue_summery(QUEUES, single_query=False, schedd=fake_schedd)
+    assert len(fake_schedd.queries) == 3
+    assert single == per_queue
+
+
+class ExprSchedd(FakeSchedd):
+    """ExprSchedd class prints RequestMemory as the expression it was submitted as"""
+    def query(self, constraint="true", projection=[]):
+        for ad in super().query(constraint, projection):
+            if "requestmemory" in ad:
+                ad = dict(ad, requestmemory="/Expr(ifThenElse(true, {}, 0))/".format(
+                    ad["requestmemory"]))
+            yield ad
+
+
+def test_queue_summery_expression(fake_schedd):
+    schedd = ExprSchedd()
+    schedd.jobs = [dict(ad, requestmemory=16000 if ad["clusterid"] == 12 else 2000)
+                   for ad in fake_schedd.jobs]
+    queues = QUEUES + [{"name": "big", "constraint": "RequestMemory > 8000"}]
+    summery = get_condor_queue_summery(queues, schedd=schedd)
+    # condor evaluates the expression, one query per queue
+    assert len(schedd.queries) == 1 + 3
+    assert summery == get_condor_queue_summery(queues, single_query=False,
+                                               schedd=FakeSchedd(schedd.jobs))
+    assert summery[2] == {"queue": "big", "idle": 0, "running": 1, "held": 0,
+                          "allocated_cores": 1, "allocated_mem": 100}
+
+
+def test_queue_summery_failure(fake_schedd):
+    # the query of "all" is killed after two jobs, "short" has only two
+    fake_schedd.fail_after = 2
+    summery = get_condor_queue_summery(QUEUES, single_query=False, schedd=fake_schedd)
+    assert [q["queue"] for q in summery] == ["short"]
+    assert get_condor_queue_summery(QUEUES, schedd=fake_schedd) == []
+
+
+def test_jobs(fake_schedd):
+    jobs = list(get_condor_jobs(schedd=fake_schedd))
+    assert {"users": "alice", "Id": "10.0", "Runtime": 120, "state": "running"} in jobs
+    assert {"users": "bob", "Id": "11.0", "Runtime": 30, "state": "held"} in jobs
+    assert all(job["users"] != "atlas-coffea" for job in jobs)
+
+
+def test_history(fake_schedd):
+    jobs = list(get_condor_history(since_insecs=time.time() - 10**6, schedd=fake_schedd))
+    assert jobs == [{"users": "carol", "Id": "5.0", "Runtime": 177}]
+
+
+def test_incremental_history(fake_schedd, tmp_path):
+    path = str(tmp_path / "condor.json")
+    mark = HistoryMark(path)
+    jobs = list(get_condor_history(schedd=fake_schedd, mark=mark, max_lookback=10**10))
+    assert [job["Id"] for job in jobs] == ["5.0"]
+    mark.save()
+
+    mark = HistoryMark(path)
+    fake_schedd.finished.append({"owner": "dave", "clusterid": 6, "procid": 0, "jobstatus": 4,
+                                 "remotewallclocktime": 1.0, "jobfinishedhookdone": 2000000001})
+    with mark.transaction():
+        assert mark.finished == 2000000000
+        jobs = list(get_condor_history(schedd=fake_schedd, mark=mark, max_lookback=10**10))
+    assert [job["Id"] for job in jobs] == ["6.0"]
+
+
+def test_incremental_history_failure(fake_schedd, tmp_path):
+    path = str(tmp_path / "condor.json")
+    # newest first, like condor_history
+    fake_schedd.finished = [{"owner": "carol", "clusterid": i, "procid": 0, "jobstatus": 4,
+                             "remotewallclocktime": 1.0, "jobfinishedhookdone": 2000000000 - i}
+                            for i in range(1, 40)]
+    fake_schedd.fail_after = 3
+    mark = HistoryMark(path)
+    jobs = []
+    with pytest.raises(RuntimeError):
+        for job in get_condor_history(schedd=fake_schedd, mark=mark, max_lookback=10**10):
+            jobs.append(job["Id"])
+    assert jobs == ["1.0", "2.0", "3.0"]
+    # the killed query doesn't move the mark
+    assert mark.finished == 0
+    mark.save()
+
+    fake_schedd.fail_after = None
+    with HistoryMark(path).transaction() as mark:
+        jobs = list(get_condor_history(schedd=fake_schedd, mark=mark, max_lookback=10**10))
+    assert len(jobs) == 39
+    assert mark.finished == 2000000000 - 1
+
+
+def test_job_tracker(tmp_path):
+    path = str(tmp_path / "jobs.json")
+    jobs = [{"users": "alice", "Id": "1.0", "Runtime": 0, "state": "idle"},
+            {"users": "bob", "Id": "2.0", "Runtime": 5, "state": "running"}]
+    tracker = JobTracker(path, heartbeat=100, resync=1000)
+    assert list(tracker.select(jobs, now=1000)) == jobs
+    tracker.save()
+
+    tracker = JobTracker(path, heartbeat=100, resync=1000)
+    jobs[0] = dict(jobs[0], state="running")
+    jobs.append({"users": "bob", "Id": "3.0", "Runtime": 0, "state": "idle"})
+    with tracker.transaction():
+        assert [j["Id"] for j in tracker.select(jobs, now=1010)] == ["1.0", "3.0"]
+    # heartbeat
+    assert [j["Id"] for j in tracker.select(jobs, now=1105)] == ["2.0"]
+    # full resync
+    assert list(tracker.select(jobs, now=2000)) == jobs
+
+
+def test_iter_json_array():
+    stream = io.BytesIO('[\n{\n "a": 1, "s": "x,]é"\n}\n,\n{"b": [1, 2]}\n]\n'.encode())
+    assert list(iter_json_array(stream, chunk_size=3)) == [{"a": 1, "s": "x,]é"}, {"b": [1, 2]}]
+    assert list(iter_json_array(io.BytesIO(b""))) == []
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.BytesIO(b'[{"a": 1}, {"b"')))
+
+
+def test_user_rollup(fake_schedd):
+    rollup = UserRollup()
+    jobs = list(rollup.feed(get_condor_jobs(schedd=fake_schedd, resources=True)))
+    assert len(jobs) == 4
+    users = {doc["users"]: doc for doc in rollup.documents()}
+    assert users["alice"] == {"users": "alice", "running": 1, "idle": 1, "held": 0, "other": 0,
+                              "allocated_cores": 4, "allocated_mem": 2048,
+                              "runtime_total": 120, "runtime_max": 120,
+                              "runtime_p50": 120, "runtime_p90": 120}
+    assert users["bob"]["held"] == 1 and users["bob"]["running"] == 1
+
+
+def test_job_tracker_failed_query(fake_schedd, tmp_path):
+    path = str(tmp_path / "jobs.json")
+    tracker = JobTracker(path, heartbeat=100, resync=1000)
+    assert len(list(tracker.select(get_condor_jobs(schedd=fake_schedd), now=1000))) == 4
+    fake_schedd.fail_after = 1
+    with pytest.raises(RuntimeError):
+        list(tracker.select(get_condor_jobs(schedd=fake_schedd), now=1010))
+    # the snapshot survives a failed condor_q, nothing is new on the next run
+    fake_schedd.fail_after = None
+    assert list(tracker.select(get_condor_jobs(schedd=fake_schedd), now=1020)) == []
+
+
+class SlowSchedd:
+    """SlowSchedd class stands in for htcondor.Schedd, answering one ad per second"""
+    def query(self, constraint="true", projection=[]):
+        for i in range(3):
+            time.sleep(i)
+            yield {"Owner": "alice", "ClusterId": i}
+
+    def history(self, constraint="true", projection=[], match=-1):
+        raise RuntimeError("schedd refused the query")
+
+
+def test_bindings_timeout():
+    schedd = BindingsSchedd(timeout=0.5, schedd=SlowSchedd())
+    ads = schedd.query()
+    assert next(ads) == {"owner": "alice", "clusterid": 0}
+    with pytest.raises(TimeoutError):
+        next(ads)
+    # errors of the bindings reach the caller
+    with pytest.raises(RuntimeError):
+        list(schedd.history())
+    assert len(list(BindingsSchedd(schedd=SlowSchedd()).query())) == 3
+
+
+def test_bounded_buffer():
+    produced = []
+
+    def read():
+        for i in range(200000):
+            produced.append(i)
+            yield {"ClusterId": i}
+
+    ads = bounded(read, timeout=10, buffer=10)
+    assert next(ads) == {"ClusterId": 0}
+    # a slow consumer: the reader waits instead of reading the whole queue
+    time.sleep(0.5)
+    assert len(produced) <= 12
+    ads.close()
+    time.sleep(0.3)
+    # and gives up once the consumer is gone
+    assert len(produced) <= 13
@@ -0,0 +1,39 @@
+import pytest
+
+from afmetrics_collector.constraint import Constraint, UNDEFINED
+
+__author__ = "Fengping Hu"
+__copyright__ = "Fengping Hu"
+__license__ = "MIT"
+
+
+def test_attributes():
+    c = Constraint('queue == "short" && MY.RequestCpus > 1 && TARGET.Memory > 1')
+    assert c.attributes == {"queue", "RequestCpus"}
+
+
+def test_matches():
+    assert Constraint("").matches({})
+    c = Constraint('queue == "short"')
+    # string == is case insensitive, =?= is not
+    assert c.matches({"queue": "Short"})
+    assert not c.matches({"queue": "long"})
+    assert not c.matches({})
+    assert not Constraint('queue =?= "short"').matches({"queue": "Short"})
+    assert Constraint('Owner =!= "atlas-coffea"').matches({})
+    assert Constraint('regexp("^a\\.b", Name) && !isUndefined(Name)').matches({"name": "a.bc"})
+    assert Constraint('x > 2 ? y == 1 : false').matches({"x": 3, "y": 1})
+
+
+def test_three_valued_logic():
+    assert Constraint("missing && false").evaluate({}) is False
+    assert Constraint("missing || true").evaluate({}) is True
+    assert Constraint("missing && true").evaluate({}) is UNDEFINED
+    assert Constraint("!missing").evaluate({}) is UNDEFINED
+
+
+def test_unsupported():
+    with pytest.raises(ValueError):
+        Constraint("splitUserName(Owner)")
+    with pytest.raises(ValueError):
+        Constraint("a == (1")
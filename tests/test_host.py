@@ -0,0 +1,181 @@
+import os
+import shutil
+import threading
+from collections import namedtuple
+
+import psutil
+
+from afmetrics_collector.host import (DiskStat, MountTable, Xdisk, Xdisks, XNode,
+                                      counter_delta, cpu_usage, get_host_metrics, io_rates,
+                                      parse_diskstats, parse_pressure, parse_proc_stat)
+from afmetrics_collector.state import StateStore
+
+__author__ = "Fengping Hu"
+__copyright__ = "Fengping Hu"
+__license__ = "MIT"
+
+DISKSTATS = """\
+   8       0 sda 10 1 100 5 10 1 100 5 0 100 100
+   8       1 sda1 10 100 10 100
+   8      16 sdb 1 2 3 4 5 6 7 8 9 10 11 12 13 14 15
+ 259       0 nvme0n1 1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17
+   7       0 loop0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0
+"""
+
+
+def test_parse_diskstats(tmp_path):
+    path = tmp_path / "diskstats"
+    path.write_text(DISKSTATS)
+    stats = parse_diskstats({"sda", "sda1", "sdb", "nvme0n1", "sdz"}, str(path))
+    assert set(stats) == {"sda", "sda1", "sdb", "nvme0n1"}
+    assert stats["sda"].ms_weighted == 100 and stats["sda"].flushes == 0
+    assert stats["sda1"].wr_sectors == 100
+    assert stats["sdb"].ms_discarding == 15
+    assert stats["nvme0n1"].ms_flushing == 17
+
+
+def test_io_rates():
+    prev = DiskStat(10, 0, 100, 5, 10, 0, 100, 5, 0, 100, 100)
+    cur = prev._replace(reads=30, rd_sectors=300, ms_reading=25, ms_doing_io=600, cur_ios=2)
+    rates = io_rates(prev, cur, 2.0)
+    assert rates["read_iops"] == 10
+    assert rates["read_bytes_per_sec"] == 200 * 512 / 2
+    assert rates["io_utilization"] == 0.25
+    assert rates["await_ms"] == 1.0
+    assert rates["cur_ios"] == 2
+    # counters reset
+    assert io_rates(cur, prev, 2.0) == {}
+
+
+MOUNTINFO = """\
+23 28 0:22 / /proc rw,relatime - proc proc rw
+28 1 254:0 / / rw,relatime - ext4 /dev/vda rw
+40 28 0:45 / /data rw,relatime shared:12 - nfs4 nfs.example.org:/data rw,vers=4.2
+41 28 0:46 / /my\\040scratch rw,relatime - tmpfs tmpfs rw
+"""
+
+
+def test_mount_table(tmp_path):
+    path = tmp_path / "mountinfo"
+    path.write_text(MOUNTINFO)
+    table = MountTable(str(path))
+    assert table.lookup("/data").fstype == "nfs4"
+    assert table.lookup("/data").device == ""
+    assert table.lookup("/data/").source == "nfs.example.org:/data"
+    assert table.lookup("/my scratch").fstype == "tmpfs"
+    assert table.lookup("/").devno == "254:0"
+    assert table.lookup("/home") is None
+
+
+def test_disk_usage_once_per_tick(monkeypatch):
+    calls = []
+    hung = threading.Event()
+
+    def disk_usage(path):
+        calls.append(path)
+        if path == "/hung":
+            hung.wait(5)
+        return (100, 40, 60)
+
+    monkeypatch.setattr(shutil, "disk_usage", disk_usage)
+    disk = Xdisk("/")
+    disk.sample_usage()
+    assert disk.get_utilization() == (100, 40, 60, 0.4)
+    assert disk.get_free_space() == 60
+    assert len(calls) == 1
+
+    xd = Xdisks([], state_persistence_file="/nonexistent/state.json")
+    xd.disks = [Xdisk("/"), Xdisk("/hung")]
+    xd.sample_usage(timeout=0.2)
+    assert not xd.disks[0].stalled and xd.disks[0].usage == (100, 40, 60)
+    assert xd.disks[1].stalled and xd.disks[1].usage is None
+    # a hung statvfs is not started again
+    xd.sample_usage(timeout=0.2)
+    assert calls.count("/hung") == 1
+    hung.set()
+
+
+Snetio = namedtuple("snetio", "bytes_sent bytes_recv packets_sent packets_recv "
+                              "errin errout dropin dropout")
+
+
+def test_interfaces(monkeypatch, tmp_path):
+    nics = {"eth0": Snetio(1000, 2000, 10, 20, 0, 0, 0, 0),
+            "lo": Snetio(5, 5, 1, 1, 0, 0, 0, 0)}
+    monkeypatch.setattr(psutil, "net_io_counters", lambda pernic=False: dict(nics))
+    path = str(tmp_path / "afmetrics.json")
+    node = XNode(path)
+    # no previous sample on the first run, no rates
+    with node.transaction():
+        assert node.get_network() is None
+        assert node.get_interfaces() == []
+        assert node.get_cpu() == {}
+        node.save()
+    with XNode(path).transaction() as node:
+        node.data_prev["timestamp"] -= 10000
+        nics["eth0"] = Snetio(3000, 2000, 30, 20, 1, 0, 0, 0)
+        nics["docker0"] = Snetio(5, 5, 1, 1, 0, 0, 0, 0)
+        # totals include the new interface, rates only start from the next run
+        assert node.get_network()["sent"] == 2005
+        interfaces = node.get_interfaces(exclude=["lo", "docker*"])
+        assert len(interfaces) == 1
+        assert interfaces[0]["interface"] == "eth0"
+        assert abs(interfaces[0]["bytes_sent_per_sec"] - 200) < 1
+        node.save()
+    with XNode(path).transaction() as node:
+        assert "docker0" in node.data_prev["interfaces"]
+
+
+def test_state_once_per_tick(monkeypatch, tmp_path):
+    loads = []
+    load = StateStore.load
+    monkeypatch.setattr(StateStore, "load",
+                        lambda store, default=None: loads.append(store.path) or
+                        load(store, default))
+    xd = Xdisks([], state_persistence_file=str(tmp_path / "disks.json"))
+    no = XNode(str(tmp_path / "afmetrics.json"))
+    assert loads == []
+    for _ in range(2):
+        get_host_metrics(xd=xd, no=no)
+    assert sorted(loads) == sorted([xd.store.path, no.store.path] * 2)
+    assert sorted(os.listdir(tmp_path)) == ["afmetrics.json", "afmetrics.json.lock",
+                                            "disks.json", "disks.json.lock"]
+
+def test_counter_delta():
+    assert counter_delta(10, 15) == 5
+    # 64 bit counters: a decrease is a reset, even near 2**32
+    assert counter_delta(2**32 - 10, 5) == 5
+    assert counter_delta(1000, 5) == 5
+
+
+PROC_STAT = """cpu  {0} 0 {1} {2} {3} 0 0 {4} 0 0
+cpu0 {0} 0 {1} {2} {3} 0 0 {4} 0 0
+cpu1 0 0 0 {5} 0 0 0 0 0 0
+intr 12345 0 0
+"""
+
+
+def test_cpu_usage(tmp_path):
+    path = tmp_path / "stat"
+    path.write_text(PROC_STAT.format(100, 100, 100, 0, 0, 100))
+    prev = parse_proc_stat(str(path))
+    assert prev["cpu"] == [100, 0, 100, 100, 0, 0, 0, 0]
+    path.write_text(PROC_STAT.format(180, 110, 100, 10, 0, 200))
+    usage = cpu_usage(prev, parse_proc_stat(str(path)))
+    assert usage["user"] == 80.0
+    assert usage["system"] == 10.0
+    assert usage["iowait"] == 10.0 and usage["idle"] == 0.0
+    assert usage["cores"] == 2
+    assert usage["busiest_core"] == 90.0
+    assert usage["saturated_cores"] == 1
+    assert cpu_usage({}, prev) == {}
+
+
+def test_pressure(tmp_path):
+    (tmp_path / "cpu").write_text("some avg10=1.50 avg60=0.20 avg300=0.00 total=1234\n")
+    (tmp_path / "io").write_text("some avg10=0.00 avg60=0.00 avg300=0.00 total=0\n"
+                                 "full avg10=3.00 avg60=0.00 avg300=0.00 total=0\n")
+    pressure = parse_pressure(dir_path=str(tmp_path))
+    assert pressure["cpu_some_avg10"] == 1.5
+    assert pressure["io_full_avg10"] == 3.0
+    assert not any(k.startswith("memory") for k in pressure)
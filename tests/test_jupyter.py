@@ -0,0 +1,132 @@
+import time
+
+from afmetrics_collector.jupyter import PodCache, get_jupyter_usage, list_pod_metadata
+
+from conftest import fake_pod
+
+__author__ = "Fengping Hu"
+__copyright__ = "Fengping Hu"
+__license__ = "MIT"
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_pod_cache(fake_kube, kube_api):
+    fake_kube.lists = [([fake_pod("jupyter-alice", "alice"), fake_pod("jupyter-bob", "bob")], "10"),
+                       ([fake_pod("jupyter-bob", "bob"), fake_pod("jupyter-dave", "dave")], "20")]
+    fake_kube.watches = [
+        [{"type": "ADDED", "object": fake_pod("jupyter-carol", "carol", resource_version="11")},
+         {"type": "ADDED", "object": fake_pod("jupyter-carol-2", "carol", resource_version="12")},
+         {"type": "DELETED", "object": fake_pod("jupyter-alice", "alice", resource_version="13")},
+         {"type": "BOOKMARK", "object": {"kind": "Pod", "apiVersion": "v1",
+                                         "metadata": {"resourceVersion": "15"}}}],
+        [{"type": "ERROR", "object": {"kind": "Status", "code": 410, "reason": "Expired",
+                                      "message": "too old resource version"}}],
+    ]
+    cache = PodCache("ns", "owner", api=kube_api, watch_timeout=1).start()
+    try:
+        assert sorted(cache.users(timeout=5)) in (["alice", "bob"], ["bob", "carol"],
+                                                  ["bob", "carol", "dave"])
+        # the expired watch is followed by a new list
+        wait_for(lambda: sorted(cache.users()) == ["bob", "dave"])
+        watches = [query.get("resourceVersion") for path, query in fake_kube.requests
+                   if query.get("watch") == "true"]
+        assert watches[:3] == ["10", "15", "20"]
+    finally:
+        cache.stop()
+
+
+def test_pod_cache_index(kube_api):
+    cache = PodCache("ns", "owner", api=kube_api)
+    cache._add("jupyter-carol", "carol")
+    cache._add("jupyter-carol-2", "carol")
+    cache._remove("jupyter-carol")
+    assert cache.owners == {"carol": {"jupyter-carol-2"}}
+    cache._remove("jupyter-carol-2")
+    cache._remove("unknown")
+    assert cache.owners == {} and cache.pods == {}
+
+
+def singleuser_pod(i, phase="Running"):
+    """a synthetic pod shaped like those zero-to-jupyterhub spawns, with made up values"""
+    pod = fake_pod("jupyter-user{}".format(i), "user{}".format(i % 700), phase=phase)
+    pod["metadata"]["labels"].update({"app": "jupyterhub", "component": "singleuser-server",
+                                      "hub.jupyter.org/servername": ""})
+    pod["metadata"]["annotations"] = {"hub.jupyter.org/username": "user{}".format(i)}
+    env = [{"name": "JUPYTERHUB_{}".format(k), "value": "x" * 40} for k in range(30)]
+    pod["spec"] = {
+        "containers": [{"name": "notebook", "image": "ml-platform:latest", "env": env,
+                        "resources": {"limits": {"cpu": "4", "memory": "16Gi"},
+                                      "requests": {"cpu": "1", "memory": "4Gi"}},
+                        "volumeMounts": [{"name": "home", "mountPath": "/home/jovyan"},
+                                         {"name": "data", "mountPath": "/data"}]}],
+        "volumes": [{"name": "home", "persistentVolumeClaim": {"claimName": "claim-" + str(i)}},
+                    {"name": "data", "nfs": {"server": "nfs.af", "path": "/data"}}],
+        "nodeName": "node{}".format(i % 40),
+        "tolerations": [{"key": "hub.jupyter.org/dedicated", "operator": "Equal",
+                         "value": "user", "effect": "NoSchedule"}]}
+    pod["status"].update({
+        "podIP": "10.0.{}.{}".format(i // 250, i % 250),
+        "conditions": [{"type": t, "status": "True", "lastTransitionTime": "2026-01-01T00:00:00Z"}
+                       for t in ("Initialized", "Ready", "ContainersReady", "PodScheduled")],
+        "containerStatuses": [{"name": "notebook", "ready": True, "restartCount": 0,
+                               "image": "ml-platform:latest", "imageID": "sha256:" + "0" * 64,
+                               "state": {"running": {"startedAt": "2026-01-01T00:00:00Z"}}}]})
+    return pod
+
+
+def test_list_pod_metadata(fake_kube, kube_api):
+    fake_kube.lists = [([singleuser_pod(i) for i in range(1200)] +
+                        [singleuser_pod(1200, phase="Pending")], "10")]
+    pods, resource_version = list_pod_metadata(kube_api, "ns", "owner", limit=500)
+    assert resource_version == "10"
+    assert len(pods) == 1200
+    assert len({pod["labels"]["owner"] for pod in pods}) == 700
+    pages = [query for path, query in fake_kube.requests]
+    assert [q.get("continue") for q in pages] == [None, "500", "1000"]
+    assert all(q["fieldSelector"] == "status.phase=Running" for q in pages)
+
+
+def test_list_pod_metadata_benchmark(fake_kube, kube_api):
+    """metadata only listing against a full listing of a large hub
+
+    The hub is 1500 synthetic :func:`singleuser_pod` pods, not a recorded
+    pod list, so only the ratio of the two listings is meaningful.
+    """
+    fake_kube.lists = [([singleuser_pod(i) for i in range(1500)], "10")]
+    start = time.perf_counter()
+    full = kube_api.list_namespaced_pod("ns", label_selector="owner")
+    full_time = time.perf_counter() - start
+    full_bytes, fake_kube.bytes_sent = fake_kube.bytes_sent, 0
+    start = time.perf_counter()
+    pods, _ = list_pod_metadata(kube_api, "ns", "owner")
+    metadata_time = time.perf_counter() - start
+    assert len(pods) == len(full.items)
+    assert fake_kube.bytes_sent < full_bytes / 5, (fake_kube.bytes_sent, full_bytes)
+    assert metadata_time < full_time, (metadata_time, full_time)
+
+
+def test_jupyter_usage(fake_kube, kube_api):
+    gpu_pod = singleuser_pod(2)
+    gpu_pod["spec"]["containers"][0]["resources"]["limits"]["nvidia.com/gpu"] = "1"
+    fake_kube.lists = [([singleuser_pod(0), singleuser_pod(700), gpu_pod], "10")]
+    fake_kube.metrics = [
+        {"metadata": {"name": "jupyter-user0"},
+         "containers": [{"name": "notebook", "usage": {"cpu": "500m", "memory": "2Gi"}}]},
+        {"metadata": {"name": "jupyter-user2"},
+         "containers": [{"name": "notebook", "usage": {"cpu": "250000000n",
+                                                       "memory": "1048576Ki"}}]}]
+    user0, user2 = get_jupyter_usage("ns", "owner", api=kube_api)
+    # user0 has two pods, user700 has just started and has no metrics yet
+    assert user0["user"] == "user0" and user0["pods"] == 2
+    assert user0["cpu_request"] == 2.0 and user0["cpu_limit"] == 8.0
+    assert user0["memory_request"] == 8 * 2**30
+    assert user0["cpu_usage"] == 0.5 and user0["cpu_efficiency"] == 0.5
+    assert user0["memory_efficiency"] == 0.5
+    assert user2["gpu_limit"] == 1 and user2["gpu_request"] == 0
+    assert user2["cpu_usage"] == 0.25 and user2["memory_usage"] == 2**30
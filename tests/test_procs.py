@@ -0,0 +1,51 @@
+import os
+
+from afmetrics_collector.procs import CLK_TCK, UserUsage, read_process, user_name
+
+__author__ = "Fengping Hu"
+__copyright__ = "Fengping Hu"
+__license__ = "MIT"
+
+
+def write_proc(proc, uptime, pids):
+    (proc / "uptime").write_text("{} 0.0\n".format(uptime))
+    for pid, (cpu, start, rss_pages, read_bytes) in pids.items():
+        (proc / pid).mkdir(exist_ok=True)
+        # the fields after the state, the command name has a space and a parenthesis
+        fields = ["0"] * 49
+        fields[10], fields[11] = str(cpu), "0"
+        fields[18], fields[20] = str(start), str(rss_pages)
+        (proc / pid / "stat").write_text("{} (my (cmd) R {}\n".format(pid, " ".join(fields)))
+        (proc / pid / "io").write_text("rchar: 1\nread_bytes: {}\nwrite_bytes: 0\n".format(
+            read_bytes))
+
+
+def test_read_process(tmp_path):
+    write_proc(tmp_path, 100, {"42": (7, 5, 3, 1024)})
+    uid, start, cpu, rss, read_bytes, write_bytes = read_process(str(tmp_path / "42"))
+    assert (uid, start, cpu, read_bytes) == (os.getuid(), 5, 7, 1024)
+    assert rss == 3 * os.sysconf("SC_PAGE_SIZE")
+    assert read_process(str(tmp_path / "43")) is None
+
+
+def test_user_usage(tmp_path):
+    proc = tmp_path / "proc"
+    proc.mkdir()
+    state = str(tmp_path / "procs.json")
+    write_proc(proc, 100, {"1": (50, 0, 1, 0)})
+    usage = UserUsage(state, min_uid=0, proc_path=str(proc)).sample()
+    assert usage == [{"user": user_name(os.getuid()), "processes": 1,
+                      "rss": os.sysconf("SC_PAGE_SIZE")}]
+
+    tracker = UserUsage(state, min_uid=0, proc_path=str(proc))
+    tracker.sample()
+    tracker.save()
+    # 10s later pid 1 used 5s, pid 2 started and used 5s, read 100 bytes
+    write_proc(proc, 110, {"1": (50 + 5 * CLK_TCK, 0, 1, 0),
+                           "2": (5 * CLK_TCK, 105 * CLK_TCK, 1, 100)})
+    with UserUsage(state, min_uid=0, proc_path=str(proc)).transaction() as tracker:
+        usage = tracker.sample()
+    assert len(usage) == 1
+    assert usage[0]["processes"] == 2
+    assert usage[0]["cpu"] == 1.0
+    assert usage[0]["read_bytes_per_sec"] == 10.0
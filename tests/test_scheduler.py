@@ -0,0 +1,57 @@
+import threading
+import time
+
+from afmetrics_collector.scheduler import Scheduler, Task
+
+__author__ = "Fengping Hu"
+__copyright__ = "Fengping Hu"
+__license__ = "MIT"
+
+
+def test_overruns():
+    lock = threading.Lock()
+    running = []
+    concurrent = []
+
+    def slow():
+        with lock:
+            running.append(1)
+            concurrent.append(len(running))
+        time.sleep(0.35)
+        with lock:
+            running.pop()
+
+    scheduler = Scheduler()
+    scheduler.add("slow", slow, 0.1)
+    scheduler.add("fast", lambda: None, 0.1)
+    thread = threading.Thread(target=scheduler.run_forever)
+    thread.start()
+    time.sleep(1)
+    scheduler.stop()
+    thread.join(5)
+    assert not thread.is_alive()
+    slow_task, fast_task = scheduler.tasks
+    # the slow task is skipped while it runs instead of piling up
+    assert slow_task.overruns >= 2
+    assert max(concurrent) == 1
+    assert 2 <= slow_task.runs <= 4
+    # and doesn't hold the others back
+    assert fast_task.overruns == 0
+    assert fast_task.runs >= 8
+
+
+def test_jitter():
+    start = time.monotonic()
+    # jitter is capped at half the interval
+    tasks = [Task("t", None, 10, jitter=100) for _ in range(100)]
+    assert all(t.jitter == 5 for t in tasks)
+    assert all(start <= t.next_run <= time.monotonic() + 5 for t in tasks)
+    for task in tasks:
+        first = task.next_run
+        task.reschedule(start)
+        assert 7.5 <= task.next_run - first <= 12.5
+    # a task that fell behind starts again within the jitter
+    task = tasks[0]
+    now = task.next_run + 100
+    task.reschedule(now)
+    assert now <= task.next_run <= now + 5
@@ -0,0 +1,63 @@
+import json
+import socket
+
+from afmetrics_collector.shipper import Shipper
+
+__author__ = "Fengping Hu"
+__copyright__ = "Fengping Hu"
+__license__ = "MIT"
+
+
+def test_batch_size(logstash):
+    shipper = Shipper(logstash.url, batch_size=3)
+    shipper.extend([{"n": i} for i in range(7)])
+    # full batches are posted while collecting, the rest on flush
+    assert len(logstash.requests) == 2
+    shipper.flush()
+    content_type, body = logstash.requests[0]
+    assert content_type == "application/json"
+    assert json.loads(body) == [{"n": 0}, {"n": 1}, {"n": 2}]
+    assert [len(json.loads(body)) for _, body in logstash.requests] == [3, 3, 1]
+    assert logstash.received == [{"n": i} for i in range(7)]
+    assert shipper.stats["batches"] == 3 and shipper.stats["documents"] == 7
+    shipper.close()
+
+
+def test_max_bytes(logstash):
+    # a compact document is 7 bytes plus a separator
+    shipper = Shipper(logstash.url, batch_size=100, max_bytes=20)
+    shipper.extend([{"n": i} for i in range(5)])
+    shipper.close()
+    assert [len(json.loads(body)) for _, body in logstash.requests] == [2, 2, 1]
+    assert all(len(body) <= 20 for _, body in logstash.requests)
+    assert logstash.received == [{"n": i} for i in range(5)]
+
+
+def test_ndjson(logstash):
+    shipper = Shipper(logstash.url, batch_size=2, fmt="ndjson")
+    shipper.extend([{"n": i} for i in range(3)])
+    shipper.close()
+    content_type, body = logstash.requests[0]
+    assert content_type == "application/x-ndjson"
+    assert body == b'{"n":0}\n{"n":1}\n'
+    assert logstash.received == [{"n": i} for i in range(3)]
+
+
+def test_errors(logstash):
+    logstash.statuses = [500]
+    shipper = Shipper(logstash.url, batch_size=2)
+    shipper.extend([{"n": i} for i in range(4)])
+    shipper.close()
+    assert shipper.stats["batches"] == 2
+    assert shipper.stats["errors"] == 1
+    assert shipper.stats["documents"] == 2
+    assert logstash.received == [{"n": 2}, {"n": 3}]
+
+    # nothing listening
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    shipper = Shipper("http://127.0.0.1:{}".format(port), timeout=5)
+    shipper.add({"n": 0})
+    shipper.close()
+    assert shipper.stats["errors"] == 1 and shipper.stats["documents"] == 0
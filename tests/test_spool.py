@@ -0,0 +1,118 @@
+import os
+
+import pytest
+
+from afmetrics_collector.shipper import Shipper
+from afmetrics_collector.spool import Spool
+
+__author__ = "Fengping Hu"
+__copyright__ = "Fengping Hu"
+__license__ = "MIT"
+
+
+def test_spool_order_and_resume(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=30)
+    for i in range(5):
+        spool.append("batch{}".format(i).encode())
+    # 14 bytes per record, two records per segment
+    assert spool.backlog() == (70, 3)
+    assert spool.peek() == b"batch0"
+    assert spool.peek() == b"batch0"
+    spool.commit()
+    assert spool.peek() == b"batch1"
+    spool.commit()
+    spool.close()
+
+    # a restart resumes after the last committed batch, in a new segment
+    spool = Spool(str(tmp_path), segment_bytes=30)
+    spool.append(b"batch5")
+    sent = []
+    while spool.peek() is not None:
+        sent.append(spool.peek())
+        spool.commit()
+    assert sent == [b"batch2", b"batch3", b"batch4", b"batch5"]
+    assert spool.backlog()[0] == 0
+    assert spool.stats["sent"] == 4
+
+
+def test_spool_eviction(tmp_path):
+    spool = Spool(str(tmp_path), max_bytes=60, segment_bytes=30)
+    for i in range(6):
+        spool.append("batch{}".format(i).encode())
+    # the oldest segments were dropped to stay within 60 bytes
+    assert spool.stats["evicted_segments"] == 1
+    assert spool.peek() == b"batch2"
+
+
+def test_spool_corrupt_record(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(b"batch0")
+    spool.append(b"batch1")
+    spool.close()
+    segment = [n for n in os.listdir(tmp_path) if n.endswith(".seg")][0]
+    with open(os.path.join(tmp_path, segment), "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b"X")
+    spool = Spool(str(tmp_path))
+    spool.append(b"batch2")
+    sent = []
+    while spool.peek() is not None:
+        sent.append(spool.peek())
+        spool.commit()
+    assert sent == [b"batch0", b"batch2"]
+    assert spool.stats["corrupt"] == 1
+
+
+def test_spool_corrupt_live_segment(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(b"batch0")
+    # corrupted while being appended to, and the only segment
+    with open(spool._path(spool.write_segment), "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b"X")
+    assert spool.peek() is None
+    assert spool.backlog() == (0, 0)
+    spool.append(b"batch1")
+    assert spool.peek() == b"batch1"
+    spool.commit()
+    assert spool.peek() is None
+    assert spool.stats["corrupt"] == 1
+
+
+def test_spool_failed_write(tmp_path, monkeypatch):
+    spool = Spool(str(tmp_path))
+    spool.append(b"batch0")
+    fsync = os.fsync
+
+    def disk_full(fd):
+        raise OSError(28, "No space left on device")
+    monkeypatch.setattr(os, "fsync", disk_full)
+    with pytest.raises(OSError):
+        spool.append(b"batch1")
+    monkeypatch.setattr(os, "fsync", fsync)
+    # the sizes still match the files, later batches go to a new segment
+    for segment, size in spool.sizes.items():
+        assert os.path.getsize(spool._path(segment)) == size
+    spool.append(b"batch2")
+    assert len(spool.sizes) == 2
+    sent = []
+    while spool.peek() is not None:
+        sent.append(spool.peek())
+        spool.commit()
+    # batch1 was flushed, just not synced
+    assert sent == [b"batch0", b"batch1", b"batch2"]
+
+
+def test_shipper_spool(tmp_path, logstash):
+    url = "http://127.0.0.1:{}".format(logstash.server_address[1])
+    logstash.statuses = [503]
+    shipper = Shipper(url, batch_size=2, spool=Spool(str(tmp_path)))
+    shipper.extend([{"n": i} for i in range(5)])
+    # nothing is posted while collecting
+    assert logstash.received == []
+    # logstash is down, the batches stay spooled
+    assert not shipper.drain()
+    assert shipper.metrics()["backlog_bytes"] > 0
+    shipper.close()
+    assert logstash.received == [{"n": i} for i in range(5)]
+    assert shipper.metrics()["backlog_bytes"] == 0
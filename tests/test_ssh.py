@@ -0,0 +1,41 @@
+from afmetrics_collector.ssh import (BOOT_TIME, DEAD_PROCESS, USER_PROCESS, UTMP_RECORD,
+                                     get_ssh_history, get_ssh_users, read_wtmp_since)
+
+__author__ = "Fengping Hu"
+__copyright__ = "Fengping Hu"
+__license__ = "MIT"
+
+
+def record(ut_type, user, tty, when, host="10.0.0.1"):
+    return UTMP_RECORD.pack(ut_type, 100, tty.encode(), b"ts/0", user.encode(), host.encode(),
+                            0, 0, 0, when, 0, 0, 0, 0, 0)
+
+
+def test_utmp(tmp_path):
+    assert UTMP_RECORD.size == 384
+    path = tmp_path / "utmp"
+    path.write_bytes(record(BOOT_TIME, "reboot", "~", 10) +
+                     record(USER_PROCESS, "alice", "pts/0", 20) +
+                     record(USER_PROCESS, "bob", "pts/1", 30) +
+                     record(USER_PROCESS, "alice", "pts/2", 40) +
+                     record(DEAD_PROCESS, "", "pts/3", 50))
+    assert get_ssh_users(str(path)) == ["alice", "bob"]
+    assert get_ssh_users(str(tmp_path / "missing")) == []
+
+
+def test_wtmp(tmp_path):
+    path = tmp_path / "wtmp"
+    records = [record(USER_PROCESS, "old", "pts/9", 10)]
+    records += [record(USER_PROCESS, "u{}".format(i), "pts/0", 100 + i) for i in range(3000)]
+    records += [record(USER_PROCESS, "carol", "pts/1", 5000),
+                record(USER_PROCESS, "dave", "pts/2", 9500),
+                record(DEAD_PROCESS, "", "pts/1", 9800),
+                record(USER_PROCESS, "erin", "pts/3", 9900)]
+    # a record being written is ignored
+    path.write_bytes(b"".join(records) + b"\0" * 100)
+    sessions = list(read_wtmp_since(9000, str(path)))
+    # carol logged in before the window and logged out in it
+    assert [s.user for s in sessions] == ["erin", "dave", "carol"]
+    assert sessions[0].tty == "pts/3" and sessions[0].host == "10.0.0.1"
+    assert sessions[0].login_time == 9900
+    assert get_ssh_history(since_insecs=1, file_path=str(path)) == []
@@ -0,0 +1,58 @@
+import json
+import os
+import threading
+
+from afmetrics_collector.state import StateStore
+
+__author__ = "Fengping Hu"
+__copyright__ = "Fengping Hu"
+__license__ = "MIT"
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "state.json")
+    store = StateStore(path)
+    assert store.load(default={}) == {}
+    store.save({"timestamp": 1, "devices": {"sda": [1, 2]}})
+    assert StateStore(path).load() == {"timestamp": 1, "devices": {"sda": [1, 2]}}
+    # only the state and its lock file, no temporary file left behind
+    assert sorted(os.listdir(tmp_path)) == ["state.json", "state.json.lock"]
+
+
+def test_unusable_state(tmp_path):
+    path = str(tmp_path / "state.json")
+    with open(path, "w") as f:
+        f.write('{"timestamp": 1, "sent"')
+    assert StateStore(path).load(default={}) == {}
+    # unversioned state from an older release
+    with open(path, "w") as f:
+        json.dump({"timestamp": 1, "sent": 2}, f)
+    assert StateStore(path).load(default={}) == {}
+    StateStore(path, version=2).save({"timestamp": 2})
+    assert StateStore(path).load(default={}) == {}
+
+
+def test_transaction(tmp_path):
+    path = str(tmp_path / "state.json")
+    store = StateStore(path)
+    store.save({"count": 0})
+    events = []
+
+    def other_run():
+        # another process sharing the state file
+        other = StateStore(path)
+        with other.transaction():
+            events.append("other")
+            other.save({"count": other.load()["count"] + 1})
+
+    with store.transaction():
+        count = store.load()["count"]
+        thread = threading.Thread(target=other_run)
+        thread.start()
+        thread.join(0.2)
+        # waits for this run to save instead of reading the same state
+        assert events == []
+        store.save({"count": count + 1})
+    thread.join()
+    assert events == ["other"]
+    assert store.load() == {"count": 2}
@@ -0,0 +1,38 @@
+import grp
+from collections import namedtuple
+
+from afmetrics_collector.users import GroupIndex, Obfuscator
+
+__author__ = "Fengping Hu"
+__copyright__ = "Fengping Hu"
+__license__ = "MIT"
+
+Group = namedtuple("Group", "gr_name gr_mem")
+
+
+def test_group_index(monkeypatch):
+    calls = []
+
+    def getgrall():
+        calls.append(1)
+        return [Group("atlas", ["alice", "bob"]), Group("cms", ["bob"])]
+
+    monkeypatch.setattr(grp, "getgrall", getgrall)
+    index = GroupIndex()
+    assert index.is_member("alice", "atlas")
+    assert not index.is_member("alice", "cms")
+    assert index.is_member("bob", "cms")
+    # unknown users only have their secondary groups
+    assert not index.is_member("nosuchuser-xyz", "atlas")
+    assert index.is_member("root", "root")
+    assert len(calls) == 1
+    assert index.stats()["hits"] == 1
+
+
+def test_obfuscator():
+    import hashlib
+    obfuscate = Obfuscator("s@lt", maxsize=2)
+    assert obfuscate("alice") == hashlib.sha256(b"s@ltalice").hexdigest()[:8]
+    assert obfuscate("alice") == obfuscate("alice")
+    assert obfuscate("alice") != obfuscate("bob")
+    assert obfuscate.stats() == {"hits": 3, "misses": 2, "users": 2}